@@ -0,0 +1,237 @@
+"""
+Backbone extraction with NumPy, for one record or many that share an x.
+
+hys.getBackboneCurve(hys.Hysteresis(xy), LPsteps, returnPeaks) builds a
+Hysteresis with an object for every cycle, although the backbone only needs
+the reversals of x and, with returnPeaks, the highest y of a few cycles.
+Here the reversals are found from the sign changes of np.diff(x), the
+backbone cycles are picked from them as getBackboneCurve does, and the cycle
+peaks are reduced with np.maximum.reduceat. As the reversals only depend on x,
+a batch of y histories simulated on the same strain (e.g. every candidate of
+a grid search) is reduced in one pass.
+
+Measured records can hold sensor noise, e.g. while the specimen is at rest
+before loading, and every wiggle of it is a reversal to getBackboneCurve.
+Excursions smaller than NOISE times the range of x are not taken as
+reversals here. SPC1.csv, Steel01hysteresis.csv and hysteresis.csv have no
+such excursions, and their backbones are the same as those of
+getBackboneCurve; Ts1_Experiment_Shear.csv has them while at rest before it
+is loaded. noise=0 gives getBackboneCurve's reversals on any record.
+"""
+import numpy as np
+
+# The excursion, as a fraction of the range of x, below which x is noise
+NOISE = 0.002
+
+
+def get_reversals(x, noise=NOISE):
+    """
+    The indexes of the reversals of x, with the first and last samples, as
+    hysteresis.data.getCycleIndexes.
+
+    A reversal is a sample higher (or lower) than both of its neighbours. On a
+    flat top the middle sample is taken, rounding down, as scipy's find_peaks.
+    Reversals that x moves away from, or towards, by no more than noise times
+    its range are dropped.
+    """
+    x = np.asarray(x, dtype=float)
+    moving = np.flatnonzero(np.diff(x))
+    direction = np.sign(np.diff(x)[moving])
+    turns = np.flatnonzero(direction[:-1] != direction[1:])
+    # A flat top from sample moving[i] + 1 up to sample moving[i + 1]
+    peaks = (moving[turns] + 1 + moving[turns + 1])//2
+    reversals = np.concatenate([[0], peaks, [len(x) - 1]])
+
+    tolerance = noise*np.ptp(x) if len(x) else 0.
+    if tolerance > 0 and len(reversals) > 2 and np.abs(np.diff(x[reversals])).min() <= tolerance:
+        reversals = _filter_reversals(x[reversals], tolerance, reversals)
+    return reversals
+
+
+def _filter_reversals(reversalX, tolerance, reversals):
+    # Keep the reversals that x then leaves by more than tolerance. Until x
+    # first moves that far from its first sample it has no direction.
+    kept = [0]
+    low = high = 0
+    step = 0
+    extreme = None
+    for i in range(1, len(reversalX) - 1):
+        value = reversalX[i]
+        if step == 0:
+            if value < reversalX[low]:
+                low = i
+            if value > reversalX[high]:
+                high = i
+            if value - reversalX[low] > tolerance:
+                step, extreme = 1, i
+                if reversalX[0] - reversalX[low] > tolerance:
+                    kept.append(low)
+            elif reversalX[high] - value > tolerance:
+                step, extreme = -1, i
+                if reversalX[high] - reversalX[0] > tolerance:
+                    kept.append(high)
+        elif (value - reversalX[extreme])*step > 0:
+            extreme = i
+        elif (reversalX[extreme] - value)*step > tolerance:
+            kept.append(extreme)
+            step, extreme = -step, i
+    if extreme is not None and (reversalX[extreme] - reversalX[-1])*step > tolerance:
+        kept.append(extreme)
+    kept.append(len(reversalX) - 1)
+    return reversals[kept]
+
+
+def get_backbone_indexes(x, LPsteps=None, noise=NOISE):
+    """
+    Return the reversal indexes of x and the positions, within them, of the
+    reversals that end a backbone cycle, as getBackboneCurve.
+    """
+    reversals = get_reversals(x, noise)
+    reversalX = np.asarray(x, dtype=float)[reversals]
+    positive = np.concatenate([[0], np.flatnonzero(np.diff(reversalX) >= 0) + 1])
+    if LPsteps is not None:
+        positive = positive[np.concatenate([[0, 1], np.cumsum(LPsteps[:-1], dtype=int) + 1])]
+    return reversals, positive
+
+
+class BackboneExtractor:
+    """
+    Backbones of y histories that share one x history.
+
+    Parameters
+    ----------
+    x : array
+        The shared x (e.g. strain) history.
+    LPsteps : list of int, optional
+        The number of cycles at each load protocol step. None puts every
+        positive reversal on the backbone.
+    returnPeaks : bool, optional
+        Add the peak of each backbone cycle, as getBackboneCurve.
+    noise : float, optional
+        The excursion, as a fraction of the range of x, below which x is
+        noise rather than a reversal.
+    """
+
+    def __init__(self, x, LPsteps=None, returnPeaks=False, noise=NOISE):
+        self.x = np.asarray(x, dtype=float)
+        self.returnPeaks = returnPeaks
+        reversals, positive = get_backbone_indexes(self.x, LPsteps, noise)
+
+        # The samples of the cycle end points
+        self.ends = reversals[positive]
+
+        # Every backbone cycle but the last runs from the reversal before its
+        # end to the end. Cycles can share a reversal, so they are reduced
+        # without their end samples, over [start, end) segments interleaved
+        # with the gaps between cycles.
+        self.cycleEnds = self.ends[1:]
+        self.bounds = np.column_stack((reversals[positive[1:] - 1], self.cycleEnds)).ravel()
+
+        if not returnPeaks:
+            # The points only depend on x, so the order is shared by every y
+            _, self.order = np.unique(self.x[self.ends], return_index=True)
+
+    def __call__(self, y):
+        """
+        The backbone of a y history of shape (n,), as an (m, 2) array, or
+        of a batch of shape (K, n), as a list of K such arrays.
+        """
+        y = np.asarray(y, dtype=float)
+        Y = np.atleast_2d(y)
+        endY = Y[:, self.ends]
+
+        if not self.returnPeaks:
+            points = self.x[self.ends][self.order]
+            backbones = [np.column_stack((points, row[self.order])) for row in endY]
+        else:
+            peakX, peakY = self.cycle_peaks(Y)
+            backbones = []
+            for k in range(len(Y)):
+                # getBackboneCurve leaves the peak of its last cycle at the origin
+                xs = np.concatenate([self.x[self.ends], peakX[k], [0.]])
+                ys = np.concatenate([endY[k], peakY[k], [0.]])
+                _, order = np.unique(xs, return_index=True)
+                backbones.append(np.column_stack((xs[order], ys[order])))
+
+        return backbones[0] if y.ndim == 1 else backbones
+
+    def cycle_peaks(self, Y):
+        """
+        The x and y of the highest y of every backbone cycle but the last,
+        each of shape (K, number of cycles).
+        """
+        if len(self.cycleEnds) == 0:
+            empty = np.empty((len(Y), 0))
+            return empty, empty
+
+        endY = Y[:, self.cycleEnds]
+        peakY = np.maximum(np.maximum.reduceat(Y, self.bounds, axis=1)[:, 0::2], endY)
+
+        # The first run of samples of each cycle at its peak, from first to
+        # last. Samples outside the cycles compare with nan and never match.
+        n = Y.shape[1]
+        samples = np.arange(n)
+        segment = np.searchsorted(self.bounds, samples, side='right')
+        target = np.full((len(Y), len(self.bounds) + 1), np.nan)
+        target[:, 1:-1:2] = peakY
+        atPeak = Y == target[:, segment]
+
+        first = np.minimum.reduceat(np.where(atPeak, samples, n), self.bounds, axis=1)[:, 0::2]
+        # Not reached before the end sample, so the peak is the end itself
+        first = np.where(first == n, self.cycleEnds, first)
+
+        firstOf = np.zeros((len(Y), len(self.bounds) + 1), dtype=int)
+        firstOf[:, 1:-1:2] = first
+        inCycle = segment % 2 == 1
+        pastRun = inCycle & ~atPeak & (samples > firstOf[:, segment])
+        last = np.minimum.reduceat(np.where(pastRun, samples, n), self.bounds, axis=1)[:, 0::2] - 1
+        last = np.where(last == n - 1, np.where(endY == peakY, self.cycleEnds, self.cycleEnds - 1),
+                        last)
+        last = np.maximum(last, first)
+
+        # As the y reversals of getCycleIndexes: a flat top within the cycle
+        # peaks at its middle, one at either end of the cycle at that end
+        starts = self.bounds[0::2]
+        peakIndex = np.where(first == starts, first,
+                             np.where(last == self.cycleEnds, last, (first + last)//2))
+
+        return self.x[peakIndex], peakY
+
+
+def get_backbone_curve(xy, LPsteps=None, returnPeaks=False, noise=NOISE):
+    """
+    The backbone of a hysteresis, as
+    hys.getBackboneCurve(hys.Hysteresis(xy), LPsteps, returnPeaks).xy.
+    """
+    xy = np.asarray(xy, dtype=float)
+    return BackboneExtractor(xy[:, 0], LPsteps, returnPeaks, noise)(xy[:, 1])
+
+
+def validate(xy, LPsteps=None):
+    """
+    Compare get_backbone_curve with hys.getBackboneCurve on a hysteresis,
+    with and without the cycle peaks, and raise a ValueError if they differ.
+    Returns the number of backbone points compared.
+    """
+    import hysteresis as hys
+
+    xy = np.asarray(xy, dtype=float)
+    compared = 0
+    for returnPeaks in (False, True):
+        expected = hys.getBackboneCurve(hys.Hysteresis(xy), LPsteps, returnPeaks=returnPeaks).xy
+        backbone = get_backbone_curve(xy, LPsteps, returnPeaks, noise=0.)
+        if backbone.shape != expected.shape or not np.array_equal(backbone, expected):
+            raise ValueError('The backbone differs from getBackboneCurve (returnPeaks={})'.format(
+                returnPeaks))
+        compared += len(backbone)
+    return compared
+
+
+if __name__ == "__main__":
+    from datasets import load_xy
+    from protocol import detect_LPsteps
+
+    for filename in ["SPC1.csv", "Steel01hysteresis.csv"]:
+        xy = np.array(load_xy(filename))
+        for LPsteps in [detect_LPsteps(xy[:, 0]), None]:
+            print(filename, LPsteps, ": ", validate(xy, LPsteps), "points match")
@@ -0,0 +1,180 @@
+"""
+Content-addressed cache for simulated backbones.
+
+A backbone depends only on the OpenSees material input list, the strain
+protocol and the lpSteps used to extract it, so the sha256 of those three is
+used as the key. Backbones are kept in an in-memory LRU and, optionally, in one
+.npz file per key in a directory on disk. The disk tier is shared by every
+process and every run, and the least recently used files are removed once the
+directory grows past its size limit.
+"""
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+# Eviction removes files until the directory is back to this fraction of
+# maxBytes, so it runs once per many puts rather than on every one
+LOW_WATER = 0.9
+
+
+def backbone_key(inputArray, strain, lpSteps):
+    """
+    Return the hex digest identifying a backbone.
+
+    Parameters
+    ----------
+    inputArray : list
+        The OpenSees material input list, e.g. ['HystereticSM', '-posEnv', ...].
+    strain : array
+        The strain history the material is driven through.
+    lpSteps : list of int
+        The number of cycles at each load protocol step.
+    """
+    digest = hashlib.sha256()
+    # json keeps the repr of every float, so equal inputs give equal text
+    digest.update(json.dumps([str(v) if isinstance(v, str) else float(v)
+                              for v in inputArray]).encode())
+    digest.update(np.ascontiguousarray(strain, dtype=float).tobytes())
+    digest.update(json.dumps([int(v) for v in lpSteps]).encode())
+    return digest.hexdigest()
+
+
+class BackboneCache:
+    """
+    Two-tier cache of backbone (x, y) arrays.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Where the .npz files are kept. None keeps the cache in memory only.
+    maxItems : int, optional
+        The number of backbones held in memory.
+    maxBytes : int, optional
+        The size limit of the directory on disk.
+    """
+
+    def __init__(self, directory=None, maxItems=1024, maxBytes=256*2**20):
+        self.directory = directory
+        self.maxItems = maxItems
+        self.maxBytes = maxBytes
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # The size of the directory, counted once and then kept up to date by
+        # put, so that the directory is only scanned to evict
+        self.diskBytes = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.diskBytes = sum(size for _, size, _ in self._entries())
+
+    def __getstate__(self):
+        # Worker processes only share the disk tier, they start with an empty
+        # memory tier instead of a pickled copy of this one
+        state = self.__dict__.copy()
+        state['memory'] = OrderedDict()
+        return state
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def _entries(self):
+        # (last use, size, path) of every backbone file in the directory
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz') and '.tmp' not in entry.name:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxItems:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        Return the cached (x, y) for key, or None.
+        """
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+
+        if self.directory is not None:
+            path = self._path(key)
+            try:
+                with np.load(path) as data:
+                    value = (data['x'], data['y'])
+                # The modification time doubles as the last use for eviction
+                os.utime(path)
+            except (OSError, KeyError, ValueError):
+                value = None
+            if value is not None:
+                self._remember(key, value)
+                self.hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    def put(self, key, x, y):
+        """
+        Store the backbone x and y under key.
+        """
+        value = (np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        self._remember(key, value)
+
+        if self.directory is not None:
+            # Write to a temporary file first so that a crash, or another
+            # process reading the same key, never sees a partial file
+            path = self._path(key)
+            try:
+                replaced = os.path.getsize(path)
+            except FileNotFoundError:
+                replaced = 0
+            temporary = '{}.{}.tmp.npz'.format(path[:-4], os.getpid())
+            np.savez(temporary, x=value[0], y=value[1])
+            size = os.path.getsize(temporary)
+            os.replace(temporary, path)
+            self.diskBytes += size - replaced
+            if self.diskBytes > self.maxBytes:
+                self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used files until the directory is down to
+        LOW_WATER of maxBytes, if it is over maxBytes.
+        """
+        if self.directory is None:
+            return
+        # Scanned again, as other processes may have added or removed files
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        if total > self.maxBytes:
+            for _, size, path in sorted(entries):
+                if total <= LOW_WATER*self.maxBytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        self.diskBytes = total
+
+    def clear(self):
+        """
+        Empty both tiers.
+        """
+        self.memory.clear()
+        if self.directory is not None:
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.npz'):
+                    os.remove(entry.path)
+        self.diskBytes = 0
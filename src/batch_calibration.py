@@ -0,0 +1,261 @@
+"""
+Calibrate many specimens against many material families in one run.
+
+A manifest (json) lists the specimens and the HystereticSM families to fit:
+
+    {
+        "specimens": [
+            {"name": "SPC1", "file": "SPC1.csv"},
+            {"name": "Wall2", "file": "wall2.csv",
+             "x": [0, 0.004], "y": [1, 100], "LPsteps": [3, 3, 3]}
+        ],
+        "materials": ["pinch", "HystereticSM_beta=0.5"],
+        "method": "brent",
+        "budget": 30,
+        "bounds": [1, 5000]
+    }
+
+Files are relative to the manifest. "x" and "y" are optional [column, scale]
+pairs for files missing from datasets.RECORDS, and LPsteps is detected from
+the record when it is not given. A material is either a key of
+OpenSeesMaterialDefaultValues or a family name, which selects every variant
+of that family.
+
+Every specimen x material pair is calibrated in a process pool, and each
+result is written to an SQLite store as soon as it finishes. Pairs already in
+the store are skipped, so an interrupted run picks up where it stopped, as
+long as their record, columns, LPsteps, method, budget and bounds are
+unchanged. A result whose M1 ends on a bound is stored as 'bound' rather than
+'done', as the search did not find a minimum within the bounds.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import openseespy.opensees as ops
+
+from backbone import get_backbone_curve
+from compare_backbones import search_M1
+from datasets import RECORDS, load_xy, _file_hash
+from get_hysteresis_data import OpenSeesMaterialDefaultValues
+from protocol import detect_LPsteps
+
+# Experimental backbones already built in this process, by specimen
+_backbones = {}
+
+# The fraction of the bounds within which an M1 is on a bound
+BOUND_RTOL = 1e-3
+
+
+def _init_worker():
+    # Start every worker from a clean OpenSees interpreter
+    ops.wipe()
+
+
+def resolve_materials(names):
+    """
+    Expand family names into the material keys of OpenSeesMaterialDefaultValues.
+    """
+    materials = []
+    for name in names:
+        if name in OpenSeesMaterialDefaultValues:
+            matches = [name]
+        else:
+            matches = [key for key in OpenSeesMaterialDefaultValues
+                       if key.startswith('HystereticSM_{}='.format(name))]
+        if not matches:
+            raise ValueError("Unknown material or family '{}'".format(name))
+        materials.extend(key for key in matches if key not in materials)
+    return materials
+
+
+def get_specimen_backbone(specimen):
+    """
+    Return the LPsteps and the backbone x and y of a specimen.
+    """
+    key = json.dumps(specimen, sort_keys=True)
+    if key not in _backbones:
+        record = None
+        if 'x' in specimen:
+            record = {'x': tuple(specimen['x']), 'y': tuple(specimen['y'])}
+        xy = load_xy(specimen['file'], record=record)
+        LPsteps = specimen.get('LPsteps') or detect_LPsteps(xy[:, 0])
+        backbone = get_backbone_curve(xy, LPsteps, returnPeaks=True)
+        _backbones[key] = (LPsteps, backbone[:, 0], backbone[:, 1])
+    return _backbones[key]
+
+
+def fingerprint(specimen, method='brent', budget=30, bounds=(1, 5000)):
+    """
+    A hash of what the calibrations of a specimen depend on besides the
+    material: the content of its record, how its columns are read, its
+    LPsteps and the search.
+    """
+    settings = {key: value for key, value in specimen.items() if key not in ('name', 'file')}
+    text = json.dumps([_file_hash(specimen['file']), RECORDS.get(os.path.basename(specimen['file'])),
+                       settings, method, budget, list(bounds)], sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def calibrate(specimen, material, method='brent', budget=30, bounds=(1, 5000)):
+    """
+    Fit M1 of one material to one specimen and return the result as a dict.
+    """
+    start = time.perf_counter()
+    LPsteps, backbone_x, backbone_y = get_specimen_backbone(specimen)
+    mins = search_M1(backbone_x, backbone_y, method, budget, bounds=tuple(bounds),
+                     material=material)
+    lower, upper = bounds
+    onBound = min(mins[1] - lower, upper - mins[1]) <= BOUND_RTOL*(upper - lower)
+    return {'status': 'bound' if onBound else 'done', 'mae': float(mins[0]), 'M1': mins[1],
+            'best_index': int(mins[4]), 'LPsteps': LPsteps,
+            'seconds': time.perf_counter() - start}
+
+
+class CalibrationStore:
+    """
+    SQLite table of calibration results, one row per specimen and material,
+    with the fingerprint of the calibration that made it.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS calibrations ('
+            ' specimen TEXT, material TEXT, status TEXT, mae REAL, M1 REAL,'
+            ' best_index INTEGER, LPsteps TEXT, method TEXT, budget INTEGER,'
+            ' seconds REAL, message TEXT, finished TEXT, fingerprint TEXT,'
+            ' PRIMARY KEY (specimen, material))')
+        # Stores written before fingerprints were kept; their rows are redone
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(calibrations)')]
+        if 'fingerprint' not in columns:
+            self.connection.execute('ALTER TABLE calibrations ADD COLUMN fingerprint TEXT')
+        self.connection.commit()
+
+    def finished(self, retryFailed=False):
+        """
+        The fingerprints of the (specimen, material) pairs that need no more
+        work, if their fingerprint is unchanged.
+        """
+        statuses = ('done', 'bound') if retryFailed else ('done', 'bound', 'failed')
+        rows = self.connection.execute(
+            'SELECT specimen, material, fingerprint FROM calibrations WHERE status IN ({})'.format(
+                ','.join('?'*len(statuses))), statuses)
+        return {(specimen, material): key for specimen, material, key in rows}
+
+    def record(self, specimen, material, method, budget, result=None, message=None,
+               fingerprint=None):
+        result = result or {}
+        self.connection.execute(
+            'INSERT OR REPLACE INTO calibrations VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)',
+            (specimen, material, 'failed' if message else result.get('status', 'done'),
+             result.get('mae'), result.get('M1'), result.get('best_index'),
+             json.dumps(result.get('LPsteps')), method, budget, result.get('seconds'),
+             message, time.strftime('%Y-%m-%d %H:%M:%S'), fingerprint))
+        self.connection.commit()
+
+    def results(self):
+        rows = self.connection.execute(
+            'SELECT specimen, material, status, mae, M1 FROM calibrations '
+            'ORDER BY specimen, mae')
+        return rows.fetchall()
+
+    def close(self):
+        self.connection.close()
+
+
+def read_manifest(path):
+    with open(path) as f:
+        manifest = json.load(f)
+    directory = os.path.dirname(os.path.abspath(path))
+    for specimen in manifest['specimens']:
+        specimen['file'] = os.path.join(directory, specimen['file'])
+        specimen.setdefault('name', os.path.splitext(os.path.basename(specimen['file']))[0])
+    manifest['materials'] = resolve_materials(manifest['materials'])
+    return manifest
+
+
+def run_manifest(manifest, store, workers=0, retryFailed=False):
+    """
+    Calibrate every specimen x material pair of the manifest not yet in the
+    store. Returns the number of calibrations run.
+    """
+    method = manifest.get('method', 'brent')
+    budget = manifest.get('budget', 30)
+    bounds = manifest.get('bounds', (1, 5000))
+
+    finished = store.finished(retryFailed)
+    fingerprints = {specimen['name']: fingerprint(specimen, method, budget, bounds)
+                    for specimen in manifest['specimens']}
+    tasks = [(specimen, material) for specimen in manifest['specimens']
+             for material in manifest['materials']
+             if finished.get((specimen['name'], material)) != fingerprints[specimen['name']]]
+    print("{} calibrations to run, {} already in the store".format(
+        len(tasks), len(manifest['specimens'])*len(manifest['materials']) - len(tasks)))
+
+    def save(specimen, material, result=None, message=None):
+        store.record(specimen['name'], material, method, budget, result, message,
+                     fingerprints[specimen['name']])
+        if message:
+            print("Failed: ", specimen['name'], material, message)
+        else:
+            print("Error: ", result['mae'], " M1: ", result['M1'], " ",
+                  specimen['name'], material,
+                  " (on a bound)" if result['status'] == 'bound' else "")
+
+    if workers == 0:
+        workers = os.cpu_count()
+    if workers == 1:
+        for specimen, material in tasks:
+            try:
+                save(specimen, material, calibrate(specimen, material, method, budget, bounds))
+            except Exception as error:
+                save(specimen, material, message=repr(error))
+        return len(tasks)
+
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+    try:
+        futures = {executor.submit(calibrate, specimen, material, method, budget, bounds):
+                   (specimen, material) for specimen, material in tasks}
+        for future in as_completed(futures):
+            specimen, material = futures[future]
+            try:
+                save(specimen, material, future.result())
+            except BrokenProcessPool:
+                # A worker died, e.g. in OpenSees. Its calibration and the
+                # queued ones are left out of the store for the next run.
+                print("Not run: ", specimen['name'], material)
+            except Exception as error:
+                save(specimen, material, message=repr(error))
+    finally:
+        # On an interruption, drop the queued work; finished results are
+        # already in the store
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    return len(tasks)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Calibrate every specimen x material of a manifest")
+    parser.add_argument("manifest", help="json manifest of specimens and materials")
+    parser.add_argument("--store", default="calibrations.sqlite",
+                        help="SQLite file the results are written to")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="number of worker processes, 0 uses every core")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="run the calibrations that failed before again")
+    args = parser.parse_args()
+
+    store = CalibrationStore(args.store)
+    try:
+        run_manifest(read_manifest(args.manifest), store, args.workers, args.retry_failed)
+        for row in store.results():
+            print(*row)
+    finally:
+        store.close()
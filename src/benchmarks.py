@@ -0,0 +1,271 @@
+"""
+Benchmarks of each stage of the backbone calibration.
+
+Every benchmark times one stage on the bundled SPC1.csv and
+Steel01hysteresis.csv, after a warm up run, and reports the median time, the
+throughput where the stage handles several candidates, and the peak memory
+allocated through Python and NumPy (tracemalloc does not see the memory used
+inside OpenSees).
+
+    python benchmarks.py                 # run and compare with the baseline
+    python benchmarks.py --save          # run and store the baseline
+    python benchmarks.py -k mae grid     # only the benchmarks matching a name
+
+Compared with a baseline, the run fails (exit status 1) if a stage is slower
+by more than --tolerance or allocates more than --memory-tolerance. The
+baseline depends on the machine, so store it on the machine that checks
+against it. A missing baseline, or a benchmark missing from it, fails the
+run too, unless --allow-missing-baseline is given.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+BASELINE_FILE = 'benchmarks_baseline.json'
+
+# Slow downs and growths below these are timer and allocator noise, whatever
+# the tolerance
+MIN_SECONDS = 0.001
+MIN_KIB = 64
+
+# name -> (setup function, number of candidates per run)
+BENCHMARKS = {}
+
+
+def benchmark(name, candidates=None):
+    """
+    Register a setup function that returns the callable to be timed.
+    """
+    def register(setup):
+        BENCHMARKS[name] = (setup, candidates)
+        return setup
+    return register
+
+
+def _experimental_backbone():
+    from backbone import get_backbone_curve
+    from datasets import load_xy
+    from protocol import detect_LPsteps
+
+    xy = load_xy('SPC1.csv')
+    backbone = get_backbone_curve(xy, detect_LPsteps(xy[:, 0]), returnPeaks=True)
+    return backbone[:, 0], backbone[:, 1]
+
+
+@benchmark('defineStrainHistory')
+def bench_strain_history():
+    from get_hysteresis_data import defineStrainHistory, peaksArray, scaleFactor, nSteps, nCycles
+    return lambda: defineStrainHistory(peaksArray, scaleFactor, nSteps, nCycles)
+
+
+@benchmark('drive_material', candidates=1)
+def bench_drive_material():
+    from get_hysteresis_data import get_session, defineMaterialValues, defaultMaterial, strain
+
+    inputArray = defineMaterialValues(2000.)[1][defaultMaterial]
+    return lambda: get_session().run(inputArray, strain)
+
+
+@benchmark('material_surrogate', candidates=100)
+def bench_material_surrogate():
+    from material_surrogate import get_hysteresis_batch
+    M1s = np.linspace(1, 5000, num=100)
+    return lambda: get_hysteresis_batch(M1s)
+
+
+@benchmark('getBackboneCurve SPC1')
+def bench_backbone_spc1():
+    import hysteresis as hys
+    from datasets import load_xy
+    from protocol import detect_LPsteps
+
+    xy = load_xy('SPC1.csv')
+    LPsteps = detect_LPsteps(xy[:, 0])
+    return lambda: hys.getBackboneCurve(hys.Hysteresis(xy), LPsteps, returnPeaks=True)
+
+
+@benchmark('getBackboneCurve Steel01')
+def bench_backbone_steel01():
+    import hysteresis as hys
+    from datasets import load_xy
+    from protocol import detect_LPsteps
+
+    xy = np.array(load_xy('Steel01hysteresis.csv'))
+    LPsteps = detect_LPsteps(xy[:, 0])
+    return lambda: hys.getBackboneCurve(hys.Hysteresis(xy), LPsteps)
+
+
+@benchmark('get_backbone_curve SPC1')
+def bench_native_backbone_spc1():
+    from backbone import get_backbone_curve
+    from datasets import load_xy
+    from protocol import detect_LPsteps
+
+    xy = load_xy('SPC1.csv')
+    LPsteps = detect_LPsteps(xy[:, 0])
+    return lambda: get_backbone_curve(xy, LPsteps, returnPeaks=True)
+
+
+@benchmark('BackboneExtractor 100', candidates=100)
+def bench_backbone_batch():
+    from backbone import BackboneExtractor
+    from material_surrogate import get_hysteresis_batch
+    from get_hysteresis_data import strainMap
+    from compare_backbones import lpSteps
+
+    _, stresses = get_hysteresis_batch(np.linspace(1, 5000, num=100))
+    extractor = BackboneExtractor(strainMap['symmCycles'], lpSteps, returnPeaks=True)
+    return lambda: extractor(stresses)
+
+
+@benchmark('get_parms/get_segments', candidates=1)
+def bench_nist_backbone():
+    from get_params import get_parms, get_segments, get_x_and_y
+    return lambda: get_x_and_y(get_segments(*get_parms()))
+
+
+@benchmark('Backbone.from_parms', candidates=10000)
+def bench_nist_backbone_batch():
+    from get_params import Backbone
+    areas = np.linspace(0.001, 0.02, 100)
+    theta_ults = np.linspace(0.01, 0.1, 100)
+    return lambda: Backbone.from_parms(areas[:, None], theta_ults[None, :])
+
+
+@benchmark('calc_mae', candidates=1)
+def bench_calc_mae():
+    from error_metrics import calc_mae
+    from get_params import get_parms, get_segments, get_x_and_y
+
+    backbone_x, backbone_y = _experimental_backbone()
+    x_values, y_values = get_x_and_y(get_segments(*get_parms()))
+    return lambda: calc_mae(x_values, y_values, backbone_x, backbone_y)
+
+
+@benchmark('grid_search 50', candidates=50)
+def bench_grid_search():
+    from compare_backbones import grid_search
+
+    backbone_x, backbone_y = _experimental_backbone()
+    M1s = np.linspace(1, 5000, num=50)
+
+    def run():
+        # grid_search prints its progress, which is not part of the timing
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                return grid_search(backbone_x, backbone_y, M1s=M1s)
+            finally:
+                sys.stdout = stdout
+    return run
+
+
+def run_benchmark(name, repeat=5):
+    setup, candidates = BENCHMARKS[name]
+    run = setup()
+    run()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {'seconds': float(np.median(times)), 'peak_kib': peak/1024}
+    if candidates is not None:
+        result['candidates_per_second'] = candidates/result['seconds']
+    return result
+
+
+def compare(results, baseline, tolerance=0.25, memoryTolerance=0.25):
+    """
+    Return a description of every regression against the baseline.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        if result['seconds'] > before['seconds']*(1 + tolerance) + MIN_SECONDS:
+            regressions.append('{}: {:.4g} s against {:.4g} s'.format(
+                name, result['seconds'], before['seconds']))
+        if result['peak_kib'] > before['peak_kib']*(1 + memoryTolerance) + MIN_KIB:
+            regressions.append('{}: {:.0f} KiB against {:.0f} KiB'.format(
+                name, result['peak_kib'], before['peak_kib']))
+    return regressions
+
+
+def main(names=None, repeat=5, save=False, baselineFile=BASELINE_FILE,
+         tolerance=0.25, memoryTolerance=0.25, allowMissing=False):
+    selected = [name for name in BENCHMARKS
+                if not names or any(key.lower() in name.lower() for key in names)]
+
+    # Fail before the slow part, a run with nothing to compare checks nothing
+    if not save and not allowMissing and not os.path.exists(baselineFile):
+        print('No baseline to compare with in {}, store one with --save'.format(baselineFile))
+        return 1
+
+    results = {}
+    for name in selected:
+        results[name] = run_benchmark(name, repeat)
+        result = results[name]
+        throughput = result.get('candidates_per_second')
+        print('{:<28} {:>10.4f} ms {:>12.0f} KiB {}'.format(
+            name, 1000*result['seconds'], result['peak_kib'],
+            '' if throughput is None else '{:.1f} candidates/s'.format(throughput)))
+
+    if save:
+        baseline = {}
+        if os.path.exists(baselineFile):
+            with open(baselineFile) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(baselineFile, 'w') as f:
+            json.dump(baseline, f, indent=4)
+        print('Saved the baseline to', baselineFile)
+        return 0
+
+    if not os.path.exists(baselineFile):
+        print('No baseline to compare with, store one with --save')
+        return 0
+
+    with open(baselineFile) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, tolerance, memoryTolerance)
+    for regression in regressions:
+        print('Regression:', regression)
+    missing = [name for name in results if name not in baseline]
+    for name in missing:
+        print('Not in the baseline:', name)
+    return 1 if regressions or (missing and not allowMissing) else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the calibration stages")
+    parser.add_argument("-k", nargs="*", default=None,
+                        help="only run the benchmarks whose name contains one of these")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="timed runs per benchmark, the median is reported")
+    parser.add_argument("--save", action="store_true",
+                        help="store the results as the baseline")
+    parser.add_argument("--baseline", default=BASELINE_FILE,
+                        help="the baseline json file")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed relative slow down before failing")
+    parser.add_argument("--memory-tolerance", type=float, default=0.25,
+                        help="allowed relative growth of the peak memory")
+    parser.add_argument("--allow-missing-baseline", action="store_true",
+                        help="pass when there is no baseline, or it lacks a benchmark")
+    args = parser.parse_args()
+    sys.exit(main(args.k, args.repeat, args.save, args.baseline,
+                  args.tolerance, args.memory_tolerance, args.allow_missing_baseline))
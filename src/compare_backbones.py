@@ -3,82 +3,147 @@
 Created on 5 April 2024
 @author: David Chan
 """
+import argparse
+from functools import partial
 import numpy as np
-import matplotlib.pyplot as plt
-import hysteresis as hys
 from sklearn.metrics import mean_absolute_error
-from get_params import get_segments, get_parms, get_x_and_y
+import get_params
+from get_params import get_segments, get_parms, get_x_and_y, Backbone
+from error_metrics import calc_mae, calc_metrics, dissipated_energy, METRICS
 from get_hysteresis_data import get_hysteresis
-
-
-def main():
+from get_hysteresis_data import defineMaterialValues, defaultMaterial, strainMap
+from grid_runner import iter_grid, run_grid
+from material_surrogate import get_hysteresis_batch
+from backbone_cache import BackboneCache, backbone_key
+from optimizers import coarse_to_fine, brent, nelder_mead
+from reporting import render_figures, hysteresis_figure, comparison_figure
+from datasets import load_xy
+from protocol import detect_LPsteps
+from early_abandon import EarlyAbandon, run_early_abandon
+from backbone import BackboneExtractor, get_backbone_curve
+from pareto import ParetoFront
+from result_store import ResultStore
+import instrumentation
+
+# The repeats at each load protocol step of the strain history, read from the
+# history so that they follow any change to peaksArray or nCycles
+lpSteps = detect_LPsteps(strainMap['symmCycles'])
+
+# Every simulation runs on the same strain history, so its reversals and
+# backbone cycles are found once
+extractor = BackboneExtractor(strainMap['symmCycles'], lpSteps)
+
+
+def main(workers=1, engine='opensees', cache=None, method='grid', budget=None,
+         sweep=False, report=True, earlyAbandon=False, pareto=False, results=None):
     backbone_file = "SPC1.csv"
-    hysteresis_data = np.loadtxt(backbone_file, delimiter=',', skiprows=2)
+    if results is not None and (sweep or pareto or method != 'grid'):
+        raise ValueError("results are only kept by the grid search")
+    if earlyAbandon and (sweep or pareto or method != 'grid'):
+        raise ValueError("earlyAbandon only applies to the grid search")
 
     # Sort the data into a xy curve
-    x = hysteresis_data[:, 1]*(1/280)
-    y = hysteresis_data[:, 0]*100
-    xy = np.column_stack([x, y])
-
-    # Make a hysteresis object
-    myHys = hys.Hysteresis(xy)
-
-    # Plot the object to see if cycles are tested properly
-    fig, ax = plt.subplots()
-    myHys.plot(True)
-    plt.savefig("hysteresis.png")
-    plt.close()
+    xy = load_xy(backbone_file)
 
     # count the number of repeats in each 'step' of the load protocol
-    LPsteps = [5, 5, 5, 3, 3, 3, 3]
+    LPsteps = detect_LPsteps(xy[:, 0])
 
     # Make the backbone curve
-    backbone = hys.getBackboneCurve(myHys, LPsteps, returnPeaks=True)
-
-    backbone_data = backbone.plot(linestyle='-.', label='Backbone')
-
-    experimental_backbone_x = backbone_data.get_xdata()
-    experimental_backbone_y = backbone_data.get_ydata()
+    backbone = get_backbone_curve(xy, LPsteps, returnPeaks=True)
+
+    experimental_backbone_x = backbone[:, 0]
+    experimental_backbone_y = backbone[:, 1]
+
+    if sweep:
+        areas = np.linspace(0.001, 0.02, 40)
+        theta_ults = np.linspace(0.01, 0.1, 40)
+        depths = np.linspace(0.5, 1.0, 6)
+        Fyes = np.array([36, 50, 65])
+        errors = sweep_backbone_parameters(experimental_backbone_x, experimental_backbone_y,
+                                           areas, theta_ults, depths, Fyes)
+        i, j, k, m = np.unravel_index(np.argmin(errors), errors.shape)
+        print("Error: ", errors[i, j, k, m], " area: ", areas[i], " theta_ult: ",
+              theta_ults[j], " d: ", depths[k], " Fye: ", Fyes[m])
+        return
+
+    if pareto:
+        # The simulations follow strainMap, not the SPC1 protocol, so their
+        # dissipated energy is not compared with that of xy
+        front = pareto_search(experimental_backbone_x, experimental_backbone_y,
+                              workers=workers, engine=engine)
+        print("Pareto front of ", len(front), " of the M1 values")
+        for metric in front.metrics:
+            M1, scores = front.best(metric)
+            if not np.isnan(scores[metric]):
+                print("Best ", metric, ": ", scores[metric], " M1: ", M1)
+        return
+
+    snapshots = []
+    # Every simulated backbone has the x of the shared extractor, so the
+    # store knows it even if the first candidate is abandoned
+    store = None
+    if results is not None:
+        store = ResultStore(extractor.x[extractor.ends][extractor.order])
+    mins = grid_search(experimental_backbone_x,
+                       experimental_backbone_y, workers, engine=engine,
+                       cache=cache, method=method, budget=budget, snapshots=snapshots,
+                       earlyAbandon=earlyAbandon, store=store)
 
-    mins = grid_search(experimental_backbone_x, experimental_backbone_y)
+    print("Error: ", mins[0], " M1: ", mins[1], " at i: ", mins[4])
 
-    plt.plot(experimental_backbone_x, experimental_backbone_y)
-    plt.plot(mins[2], mins[3])
+    if store is not None:
+        with store:
+            store.save(results)
+            print("Saved the backbones of ", len(store), " M1 values to ", results)
 
-    plt.savefig(
-        "FINAL Steel {} standard_backbone vs experimental backbone.png".format(mins[4]))
-    plt.close()
+    if report:
+        write_report(xy, experimental_backbone_x, experimental_backbone_y, mins, snapshots)
 
-    print("Error: ", mins[0], " M1: ", mins[1], " at i: ", mins[4])
 
-    mins[5].plot(True)
-    # myHys.plot(True)
-    plt.savefig("Experimental vs Generated Hysteresis.png")
+def write_report(xy, backbone_x, backbone_y, mins, snapshots=(), workers=0):
+    # Plot the experimental hysteresis to see if cycles are tested properly,
+    # the search progress and the best backbone and hysteresis found
+    experimental = (backbone_x, backbone_y)
+    jobs = [(hysteresis_figure, (xy, "hysteresis.png"))]
+    for i, x_values, y_values in snapshots:
+        jobs.append((comparison_figure, (
+            [(x_values, y_values), experimental],
+            "figs/Steel {}. standard_backbone vs experimental backbone.png".format(i))))
+    jobs.append((comparison_figure, (
+        [experimental, (mins[2], mins[3])],
+        "FINAL Steel {} standard_backbone vs experimental backbone.png".format(mins[4]))))
+    jobs.append((hysteresis_figure, (
+        mins[5], "Experimental vs Generated Hysteresis.png")))
 
+    with instrumentation.stage('report'):
+        return render_figures(jobs, workers)
 
-def get_hysteresis_backbone(M1):
-    x, y = get_hysteresis(M1)
-    xy = np.column_stack((x, y))
-    """
-    There are [x] repeats at each load protocol step, and y steps in total.
-    """
-    lpSteps = [3]*20
 
-    # Make the Hysteresis object
-    myHys = hys.Hysteresis(xy)
+def get_hysteresis_backbone(M1, material=defaultMaterial):
+    import hysteresis as hys
 
-    # Get the backbone
-    backbone = hys.getBackboneCurve(myHys, lpSteps)
+    x, y = get_hysteresis(M1, material)
+    backbone_x, backbone_y = get_backbone(x, y)
+    return backbone_x, backbone_y, hys.Hysteresis(np.column_stack((x, y)))
 
-    backbone_data = backbone.plot(label='Analysis Backbone Data', color='red')
 
-    backbone_x = backbone_data.get_xdata()
-    backbone_y = backbone_data.get_ydata()
+@instrumentation.timed('backbone')
+def get_backbone(x, y):
+    # Get the backbone, y may also be a batch of histories on the same x.
+    # lpSteps is the protocol of strainMap, any other x has its own.
+    if x is extractor.x or np.array_equal(x, extractor.x):
+        backbone = extractor(y)
+    else:
+        backbone = BackboneExtractor(x, detect_LPsteps(x))(y)
 
-    return backbone_x, backbone_y, myHys
+    if np.ndim(y) == 2:
+        return [(xy[:, 0], xy[:, 1]) for xy in backbone]
+    return backbone[:, 0], backbone[:, 1]
 
 
 def plot_backbone(backbone):
+    import matplotlib.pyplot as plt
+
     # Plot
     fig, ax = plt.subplots()
     backbone_data = backbone.plot(label='Analysis Backbone Data', color='red')
@@ -94,49 +159,276 @@ def plot_backbone(backbone):
     return ax, backbone_data
 
 
-def grid_search(backbone_x, backbone_y):
+def get_backbone_key(M1, material=defaultMaterial):
+    return backbone_key(defineMaterialValues(M1)[1][material],
+                        strainMap['symmCycles'], lpSteps)
+
+
+def get_cached_backbone(M1, cache=None, material=defaultMaterial):
+    if cache is None:
+        return get_backbone(*get_hysteresis(M1, material))
+
+    key = get_backbone_key(M1, material)
+    with instrumentation.stage('cache'):
+        cached = cache.get(key)
+    instrumentation.count('cache misses' if cached is None else 'cache hits')
+    if cached is None:
+        cached = get_backbone(*get_hysteresis(M1, material))
+        with instrumentation.stage('cache'):
+            cache.put(key, *cached)
+    return cached
+
+
+def evaluate_candidate(M1, backbone_x, backbone_y, cache=None, material=defaultMaterial):
+    with instrumentation.candidate():
+        x_values, y_values = get_cached_backbone(M1, cache, material)
+        with instrumentation.stage('mae'):
+            mae = calc_mae(x_values, y_values, backbone_x, backbone_y)
+    return mae, x_values, y_values
+
+
+def evaluate_batch(M1s, backbone_x, backbone_y, cache=None, material=defaultMaterial):
+    # Simulate every candidate missing from the cache in one pass of the
+    # NumPy surrogate, then extract every backbone at once and score each.
+    # --profile-sample profiles the whole batch that holds the sample.
+    with instrumentation.batch(len(M1s)):
+        backbones = [None]*len(M1s)
+        if cache is not None:
+            keys = [get_backbone_key(M1, material) for M1 in M1s]
+            backbones = [cache.get(key) for key in keys]
+        missing = [i for i, backbone in enumerate(backbones) if backbone is None]
+
+        if missing:
+            with instrumentation.stage('surrogate'):
+                strain, stresses = get_hysteresis_batch([M1s[i] for i in missing], material)
+            instrumentation.count('strain steps', len(strain)*len(missing))
+            for i, backbone in zip(missing, get_backbone(strain, np.atleast_2d(stresses))):
+                backbones[i] = backbone
+                if cache is not None:
+                    cache.put(keys[i], *backbones[i])
+
+        results = []
+        for x_values, y_values in backbones:
+            with instrumentation.stage('mae'):
+                mae = calc_mae(x_values, y_values, backbone_x, backbone_y)
+            results.append((mae, x_values, y_values))
+            instrumentation.advance()
+    return results
+
+
+def score_candidate(M1, backbone_x, backbone_y, energy=None, material=defaultMaterial):
+    with instrumentation.candidate():
+        x, y = get_hysteresis(M1, material)
+        x_values, y_values = get_backbone(x, y)
+        with instrumentation.stage('metrics'):
+            scores = calc_metrics(x_values, y_values, backbone_x, backbone_y,
+                                  dissipated_energy(x, y), energy)
+    return scores
+
+
+def pareto_search(backbone_x, backbone_y, xy=None, M1s=None, workers=1, chunksize=None,
+                  engine='opensees', material=defaultMaterial):
+    """
+    Score every M1 on all of error_metrics.METRICS in one simulation each
+    and return the ParetoFront of the M1 values.
+
+    xy is the experimental hysteresis, whose dissipated energy the energy
+    of each simulation is compared with. The simulations follow strainMap
+    rather than the test protocol, so the energy error only compares like
+    with like when the two protocols match. Without xy it is left out.
+    """
+    if M1s is None:
+        M1s = np.linspace(1, 5000, num=500)
+    instrumentation.expect(len(M1s))
+    energy = None if xy is None else dissipated_energy(xy[:, 0], xy[:, 1])
+
+    if engine == 'numpy':
+        with instrumentation.batch(len(M1s)):
+            with instrumentation.stage('surrogate'):
+                strain, stresses = get_hysteresis_batch(M1s, material)
+            backbones = get_backbone(strain, np.atleast_2d(stresses))
+            with instrumentation.stage('metrics'):
+                scores = calc_metrics(backbones[0][0], np.array([y for _, y in backbones]),
+                                      backbone_x, backbone_y,
+                                      dissipated_energy(strain, stresses), energy)
+        results = scores
+        instrumentation.advance(len(M1s))
+    else:
+        score = partial(score_candidate, backbone_x=backbone_x, backbone_y=backbone_y,
+                        energy=energy, material=material)
+        results = run_grid(score, M1s, workers, chunksize, instrumentation.advance)
+
+    front = ParetoFront(METRICS)
+    front.extend([float(M1) for M1 in M1s], results)
+    return front
+
+
+def search_M1(backbone_x, backbone_y, method, budget=None, workers=1, chunksize=None,
+              engine='opensees', cache=None, bounds=(1, 5000), material=defaultMaterial):
+    """
+    Find the best M1 with one of the optimizers in optimizers.py, which need
+    far fewer simulations than the full grid. Returns the mins list of
+    grid_search.
+    """
+    if engine == 'numpy':
+        def evaluate_many(M1s):
+            return evaluate_batch(M1s, backbone_x, backbone_y, cache, material)
+    else:
+        evaluate = partial(evaluate_candidate, backbone_x=backbone_x, backbone_y=backbone_y,
+                           cache=cache, material=material)
+
+        def evaluate_many(M1s):
+            return run_grid(evaluate, M1s, workers, chunksize, instrumentation.advance)
+
+    def objective(M1):
+        return evaluate_many([float(M1)])[0]
+
+    budget = budget or {'coarse': 60, 'brent': 30, 'nelder-mead': 40}.get(method)
+    instrumentation.expect(budget)
+    if method == 'coarse':
+        mins = coarse_to_fine(objective, bounds, budget, evaluate_many=evaluate_many)
+    elif method == 'brent':
+        mins = brent(objective, bounds, budget)
+    elif method == 'nelder-mead':
+        mins = nelder_mead(lambda params: objective(params[0]), [np.mean(bounds)],
+                           bounds=[bounds], budget=budget, xtol=1e-4*np.ptp(bounds))
+        mins[1] = mins[1][0]
+    else:
+        raise ValueError("Unknown method '{}'".format(method))
+
+    mins[1] = float(mins[1])
+    return mins
 
-    M1s = np.linspace(1, 5000, num=500)
-    mins = [float('inf'), 0, 0, 0, 0, 0]
-    i = 0
 
-    for M1 in M1s:
-        x_values, y_values, hysteresis_xy = get_hysteresis_backbone(M1)
+def sweep_backbone_parameters(backbone_x, backbone_y, area, theta_ult, d=None, Fye=None,
+                              chunksize=4096):
+    """
+    Score the NIST backbone of get_params for every combination of the
+    parameters against a backbone.
+
+    Returns the MAE in an array of shape
+    (len(area), len(theta_ult), len(d), len(Fye)). d and Fye default to
+    the values in get_params. Each candidate is kept as its vertices and
+    evaluated at exactly the x of the backbone, so the error carries no
+    sampling error. The candidates are built and scored chunksize at a time,
+    which bounds the memory of very large sweeps.
+    """
+    d = get_params.d if d is None else d
+    Fye = get_params.Fye if Fye is None else Fye
+    grids = np.meshgrid(*[np.atleast_1d(v) for v in (area, theta_ult, d, Fye)],
+                        indexing='ij')
+    candidates = [grid.ravel() for grid in grids]
+
+    errors = np.empty(candidates[0].size)
+    for start in range(0, errors.size, chunksize):
+        backbones = Backbone.from_parms(*[v[start:start + chunksize] for v in candidates])
+        errors[start:start + chunksize] = backbones.mae(backbone_x, backbone_y)
+
+    return errors.reshape(grids[0].shape)
+
+
+def grid_search(backbone_x, backbone_y, workers=1, chunksize=None, engine='opensees',
+                cache=None, method='grid', budget=None, snapshots=None, M1s=None,
+                earlyAbandon=False, store=None):
+    # Every 100th candidate is appended to snapshots as (i, x_values, y_values)
+    # for the report, which draws them once the search is done. With
+    # earlyAbandon, candidates that cannot beat the best so far stop
+    # simulating and score inf, and are left out of the snapshots. Every
+    # candidate of the grid is also appended to store, a ResultStore, if
+    # given. The results are reduced as their chunks come back from the
+    # workers, and only the arrays of the best so far are kept. mins[5] is
+    # the xy of the best hysteresis.
+
+    if method != 'grid':
+        mins = search_M1(backbone_x, backbone_y, method, budget, workers, chunksize,
+                         engine, cache)
+        print("Error: ", mins[0], "M1: ", mins[1])
+        mins[5] = np.column_stack(get_hysteresis(mins[1]))
+        return mins
+
+    if M1s is None:
+        M1s = np.linspace(1, 5000, num=500)
+    instrumentation.expect(len(M1s))
+    mins = [float('inf'), 0, 0, 0, 0, 0]
 
-        mae = calc_mae(x_values, y_values,
-                       backbone_x, backbone_y)
+    if earlyAbandon:
+        if engine != 'opensees' or cache is not None:
+            raise ValueError("earlyAbandon needs the opensees engine and no cache")
+        evaluate = EarlyAbandon(backbone_x, backbone_y, strainMap['symmCycles'], lpSteps)
+        results = run_early_abandon(evaluate, M1s, workers, chunksize, instrumentation.advance)
+    elif engine == 'numpy':
+        results = evaluate_batch(M1s, backbone_x, backbone_y, cache)
+    else:
+        evaluate = partial(evaluate_candidate,
+                           backbone_x=backbone_x, backbone_y=backbone_y, cache=cache)
+        results = iter_grid(evaluate, M1s, workers, chunksize, instrumentation.advance)
+
+    for i, (mae, x_values, y_values) in enumerate(results):
+        if store is not None:
+            store.append(M1s[i], mae, x_values, y_values)
         if mae < mins[0]:
             mins[0] = mae
-            mins[1] = M1
+            mins[1] = M1s[i]
             mins[2] = x_values
             mins[3] = y_values
             mins[4] = i
-            mins[5] = hysteresis_xy
 
         if i % 100 == 0:
             print("Error: ", mins[0], "M1: ", mins[1])
-            plt.plot(x_values, y_values)
-            plt.plot(backbone_x, backbone_y)
+            if snapshots is not None and x_values is not None:
+                snapshots.append((i, x_values, y_values))
 
-            plt.savefig(
-                "figs/Steel {}. standard_backbone vs experimental backbone.png".format(i))
-            plt.close()
-        i += 1
+    # Only the winning hysteresis is kept, so rebuild it rather than sending
+    # every candidate's history back from the workers.
+    if mins[0] < float('inf'):
+        mins[5] = np.column_stack(get_hysteresis(mins[1]))
 
     return mins
 
 
-def calc_mae(predicted_backbone_x, predicted_backbone_y, backbone_x, backbone_y):
-
-    # Find the closest x_dense points to each x_sparse point and their corresponding y values
-    y_dense_matched = np.array(
-        [predicted_backbone_y[np.argmin(np.abs(predicted_backbone_x - x_val))] for x_val in backbone_x])
-
-    # Calculate the Mean Absolute Error (MAE)
-    mae = np.mean(np.abs(y_dense_matched - backbone_y))
-
-    return mae
-
-
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(
+        description="Grid search the OpenSees backbone against SPC1.csv")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes, 0 uses every core")
+    parser.add_argument("--engine", choices=["opensees", "numpy"], default="opensees",
+                        help="simulate with OpenSees or the batched NumPy surrogate")
+    parser.add_argument("--cache", default=None,
+                        help="directory to keep simulated backbones in between runs")
+    parser.add_argument("--method", choices=["grid", "coarse", "brent", "nelder-mead"],
+                        default="grid", help="search every M1 or use an optimizer")
+    parser.add_argument("--budget", type=int, default=None,
+                        help="largest number of simulations for an optimizer")
+    parser.add_argument("--sweep", action="store_true",
+                        help="sweep area, theta_ult, d and Fye of the NIST backbone instead")
+    parser.add_argument("--no-report", action="store_true",
+                        help="skip drawing the figures after the search")
+    parser.add_argument("--early-abandon", action="store_true",
+                        help="stop simulating candidates that cannot beat the best so far")
+    parser.add_argument("--pareto", action="store_true",
+                        help="score every M1 on every metric and print the Pareto front")
+    parser.add_argument("--results", default=None,
+                        help="save the backbone of every M1 of the grid to this .npz")
+    parser.add_argument("--profile", default=None,
+                        help="time every stage and write the profile to this .json or .csv")
+    parser.add_argument("--profile-sample", type=int, default=None,
+                        help="run this candidate, or with --engine numpy the batch that "
+                             "holds it, under cProfile and tracemalloc")
+    args = parser.parse_args()
+    if args.results is not None and (args.sweep or args.pareto or args.method != "grid"):
+        parser.error("--results only keeps the backbones of --method grid, "
+                     "not of --sweep, --pareto or an optimizer")
+    if args.early_abandon and (args.sweep or args.pareto or args.method != "grid"):
+        parser.error("--early-abandon only applies to --method grid, "
+                     "not to --sweep, --pareto or an optimizer")
+    if args.early_abandon and (args.engine != "opensees" or args.cache is not None):
+        parser.error("--early-abandon needs --engine opensees and no --cache")
+    cache = None if args.cache is None else BackboneCache(args.cache)
+    if args.profile is None:
+        main(args.workers, args.engine, cache, args.method, args.budget, args.sweep,
+             not args.no_report, args.early_abandon, args.pareto, args.results)
+    else:
+        with instrumentation.Profile(sample=args.profile_sample) as profile:
+            main(args.workers, args.engine, cache, args.method, args.budget, args.sweep,
+                 not args.no_report, args.early_abandon, args.pareto, args.results)
+        profile.dump(args.profile)
@@ -0,0 +1,199 @@
+"""
+Loading of experimental and analysis records stored as csv files.
+
+A csv is parsed once and saved next to it as a .npy sidecar, with a small .json
+file holding the column names, units and the size, modification time and
+sha256 of the source. Later loads memory-map the sidecar instead of parsing
+the text again. The sidecar is rebuilt whenever the source changes.
+
+RECORDS declares how the columns of each experimental record are converted
+to the deformation (x) and stress (y) of the OpenSees model, so the scale
+factors are kept in one place rather than at every call site. Columns are
+given by name, or by position for files without a header.
+"""
+import hashlib
+import json
+import os
+from itertools import islice
+
+import numpy as np
+
+RECORDS = {
+    'SPC1.csv': {'x': ('Lead Actuator Displacment', 1/280),
+                 'y': ('Lead Actuator Force', 100)},
+    'hysteresis.csv': {'x': ('strain', 1), 'y': ('stress', 1)},
+    'Steel01hysteresis.csv': {'x': ('strain', 1), 'y': ('stress', 1)},
+    # In the units of the test: the size of the specimen, and with it the
+    # conversion to the model, is not known
+    'Ts1_Experiment_Shear.csv': {'x': (0, 1), 'y': (1, 1)},
+}
+
+
+def _is_number(text):
+    try:
+        float(text)
+    except ValueError:
+        return False
+    return True
+
+
+def _read_header(filename):
+    # The leading lines that are not numbers: the column names, then units
+    header = []
+    with open(filename, 'r', encoding='utf-8-sig') as f:
+        for line in f:
+            fields = [field.strip() for field in line.split(',')]
+            if all(_is_number(field) for field in fields if field):
+                break
+            header.append(fields)
+    return header
+
+
+def _file_hash(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_atomic(path, write, mode='w'):
+    # Other processes may have the old file memory-mapped, so it is replaced
+    # rather than truncated and rewritten in place
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(temporary, mode) as f:
+            write(f)
+        os.replace(temporary, path)
+    except BaseException:
+        # A failed write, e.g. to a full or read-only disk, leaves no partial
+        # file behind
+        try:
+            os.remove(temporary)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _load_sidecar(filename):
+    # The memory-mapped sidecar, names and units, or None if it is missing
+    # or older than the source
+    sidecar = filename + '.npy'
+    metadataFile = filename + '.json'
+    if not (os.path.exists(sidecar) and os.path.exists(metadataFile)):
+        return None
+
+    stat = os.stat(filename)
+    with open(metadataFile) as f:
+        metadata = json.load(f)
+    fresh = (metadata['size'] == stat.st_size and
+             metadata['mtime_ns'] == stat.st_mtime_ns)
+    if not fresh and metadata['size'] == stat.st_size:
+        # Touched but possibly unchanged, e.g. after a checkout
+        fresh = metadata['sha256'] == _file_hash(filename)
+        if fresh:
+            metadata['mtime_ns'] = stat.st_mtime_ns
+            _write_atomic(metadataFile, lambda f: json.dump(metadata, f))
+    if not fresh:
+        return None
+
+    return np.load(sidecar, mmap_mode='r'), metadata['names'], metadata['units']
+
+
+def read_csv(filename, cache=True):
+    """
+    Read a numeric csv with up to two header lines (column names and units).
+
+    Parameters
+    ----------
+    filename : str
+        The csv file.
+    cache : bool, optional
+        Keep a .npy sidecar of the data and memory-map it on later loads.
+
+    Returns
+    -------
+    data : array
+        The (rows, columns) data, a read-only memory map when cached.
+    names, units : list of str
+        The column names and units, empty if the file has no such header.
+    """
+    if cache:
+        cached = _load_sidecar(filename)
+        if cached is not None:
+            return cached
+
+    sidecar = filename + '.npy'
+    metadataFile = filename + '.json'
+    stat = os.stat(filename)
+    header = _read_header(filename)
+    data = np.loadtxt(filename, delimiter=',', skiprows=len(header), ndmin=2,
+                      encoding='utf-8-sig')
+    names = header[0] if len(header) > 0 else []
+    units = header[1] if len(header) > 1 else []
+
+    if cache:
+        metadata = {'names': names, 'units': units, 'size': stat.st_size,
+                    'mtime_ns': stat.st_mtime_ns, 'sha256': _file_hash(filename)}
+        try:
+            _write_atomic(sidecar, lambda f: np.save(f, data), 'wb')
+            _write_atomic(metadataFile, lambda f: json.dump(metadata, f))
+        except OSError:
+            # A read-only directory only costs the speed up
+            return data, names, units
+        return np.load(sidecar, mmap_mode='r'), names, units
+
+    return data, names, units
+
+
+def load_xy(filename, xScale=None, yScale=None, cache=True, record=None):
+    """
+    Load a record as an (N, 2) array of deformation and stress.
+
+    The columns and scale factors come from RECORDS, or from record, a dict
+    in the same form for files that are not listed there. xScale and yScale
+    override the declared factors.
+    """
+    data, names, _ = read_csv(filename, cache)
+    return _to_xy(data, names, filename, xScale, yScale, record)
+
+
+def _to_xy(data, names, filename, xScale, yScale, record=None):
+    if record is None:
+        record = RECORDS[os.path.basename(filename)]
+
+    columns = []
+    for axis, scale in (('x', xScale), ('y', yScale)):
+        name, declaredScale = record[axis]
+        column = data[:, name if isinstance(name, int) else names.index(name)]
+        columns.append(column*(declaredScale if scale is None else scale))
+
+    return np.column_stack(columns)
+
+
+def iter_xy(filename, chunksize=2**16, xScale=None, yScale=None):
+    """
+    Yield a record as (chunksize, 2) arrays of deformation and stress, as
+    load_xy, without holding the whole record in memory.
+
+    A fresh sidecar is read through its memory map, otherwise the csv text
+    is parsed chunksize lines at a time.
+    """
+    cached = _load_sidecar(filename)
+    if cached is not None:
+        data, names, _ = cached
+        for start in range(0, data.shape[0], chunksize):
+            yield _to_xy(data[start:start + chunksize], names, filename, xScale, yScale)
+        return
+
+    header = _read_header(filename)
+    names = header[0] if header else []
+    with open(filename, 'r', encoding='utf-8-sig') as f:
+        for _ in header:
+            next(f)
+        while True:
+            lines = list(islice(f, chunksize))
+            if not lines:
+                break
+            data = np.loadtxt(lines, delimiter=',', ndmin=2)
+            yield _to_xy(data, names, filename, xScale, yScale)
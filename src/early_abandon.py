@@ -0,0 +1,146 @@
+"""
+Early abandoning of grid search candidates that cannot beat the best so far.
+
+The x of a simulated backbone, and the strain step each of its points comes
+from, depend only on the strain history and LPsteps; the material only sets
+the stress. So before any simulation, every point of the experimental
+backbone is matched to the strain step whose stress calc_mae will compare it
+with. While a candidate is driven through the history, each error term is
+final as soon as its step has been applied, and the sum of the terms so far
+bounds the MAE from below. Once that bound exceeds the best MAE found, the
+candidate is abandoned and the rest of its history is never simulated.
+
+How much is saved depends on how soon a good candidate is found, so
+run_early_abandon first evaluates an evenly spaced subset of the grid and
+starts the rest from the best of those. Candidates that are not abandoned are
+scored with calc_mae on their full backbone, so the errors, and the best
+candidate, are exactly those of the full search.
+"""
+import numpy as np
+
+import instrumentation
+from backbone import BackboneExtractor
+from error_metrics import calc_mae, match_nearest
+from get_hysteresis_data import defineMaterialValues, defaultMaterial, drive_material, get_session
+from grid_runner import iter_grid, run_grid
+
+
+def get_backbone_steps(strain, LPsteps):
+    """
+    Return the x of the backbone of a simulation on strain, and the index of
+    the strain step each of its points comes from.
+    """
+    extractor = BackboneExtractor(strain, LPsteps)
+    steps = extractor.ends[extractor.order]
+    return extractor.x[steps], steps
+
+
+class EarlyAbandon:
+    """
+    Picklable evaluate function for run_grid that abandons candidates whose
+    MAE is bound to be worse than the best seen by this evaluator.
+
+    An abandoned candidate returns (inf, None, None). Each chunk sent to a
+    worker carries its own copy, so a candidate is only abandoned against a
+    better one earlier in its chunk, which leaves the best candidate and the
+    first index among equal errors as in the full search.
+
+    Parameters
+    ----------
+    backbone_x, backbone_y : arrays
+        The experimental backbone.
+    strain : array
+        The strain history of every candidate.
+    LPsteps : list of int
+        The load protocol steps used to extract the simulated backbones.
+    material : str, optional
+        A key of OpenSeesMaterialDefaultValues.
+    incumbent : float, optional
+        A known MAE to beat, e.g. from an earlier search.
+    """
+
+    def __init__(self, backbone_x, backbone_y, strain, LPsteps, material=defaultMaterial,
+                 incumbent=float('inf')):
+        self.backbone_x = np.asarray(backbone_x, dtype=float)
+        self.backbone_y = np.asarray(backbone_y, dtype=float)
+        self.strain = np.asarray(strain, dtype=float)
+        self.LPsteps = LPsteps
+        self.material = material
+        self.incumbent = incumbent
+        # Sliced into the segments driven between checkpoints
+        self.strainList = self.strain.tolist()
+
+        # The step each experimental point is compared at, in the order the
+        # simulation reaches them
+        x_values, self.steps = get_backbone_steps(self.strain, LPsteps)
+        pointSteps = self.steps[match_nearest(x_values, self.backbone_x)]
+        order = np.argsort(pointSteps, kind='stable')
+        checkpoints, starts = np.unique(pointSteps[order], return_index=True)
+        self.checkpoints = checkpoints.tolist()
+        self.groups = np.split(order, starts[1:])
+
+    def __call__(self, M1):
+        with instrumentation.candidate():
+            result = self.evaluate(M1)
+        if result[0] < self.incumbent:
+            self.incumbent = result[0]
+        return result
+
+    def evaluate(self, M1):
+        inputArray = defineMaterialValues(M1)[1][self.material]
+        with instrumentation.stage('define material'):
+            tag = get_session().define(inputArray)
+
+        # The MAE is at least errorSum/N, abandon once that is worse than the
+        # incumbent (with a margin for the different order of summation)
+        limit = self.incumbent*len(self.backbone_y)*(1 + 1e-12)
+        errorSum = 0.
+        stress = np.empty(len(self.strain))
+        start = 0
+        with instrumentation.stage('opensees'):
+            for checkpoint, group in zip(self.checkpoints, self.groups):
+                stress[start:checkpoint + 1] = drive_material(
+                    self.strainList[start:checkpoint + 1], tag)
+                start = checkpoint + 1
+                errorSum += np.abs(stress[checkpoint] - self.backbone_y[group]).sum()
+                if errorSum > limit:
+                    break
+            else:
+                stress[start:] = drive_material(self.strainList[start:], tag)
+                start = len(self.strain)
+        instrumentation.count('strain steps', start)
+
+        if start < len(self.strain):
+            instrumentation.count('abandoned')
+            return float('inf'), None, None
+
+        # The backbone is the stress at the known steps, as get_backbone
+        x_values = self.strain[self.steps]
+        y_values = stress[self.steps]
+        with instrumentation.stage('mae'):
+            mae = calc_mae(x_values, y_values, self.backbone_x, self.backbone_y)
+        return mae, x_values, y_values
+
+
+def run_early_abandon(evaluate, candidates, workers=1, chunksize=None, onChunk=None,
+                      stride=25):
+    """
+    iter_grid with an EarlyAbandon, seeded from every stride-th candidate.
+
+    The seed candidates are evaluated first and the best of them becomes the
+    incumbent the other candidates have to beat. Results are yielded in
+    candidate order, as iter_grid, and only those of the seeds are held.
+    """
+    candidates = list(candidates)
+    seeds = list(range(0, len(candidates), stride))
+    others = [i for i in range(len(candidates)) if i % stride]
+
+    seedResults = dict(zip(seeds, run_grid(evaluate, [candidates[i] for i in seeds],
+                                           workers, chunksize, onChunk)))
+    evaluate.incumbent = min([evaluate.incumbent] + [result[0] for result in
+                                                     seedResults.values()])
+
+    results = iter_grid(evaluate, [candidates[i] for i in others], workers, chunksize,
+                        onChunk)
+    for i in range(len(candidates)):
+        yield seedResults.pop(i) if i % stride == 0 else next(results)
@@ -0,0 +1,147 @@
+"""
+Error metrics used to compare a predicted backbone against an experimental one.
+
+The predicted curve is sorted once and every experimental point is matched to
+its nearest predicted point with a sorted search, which is O((N+M) log M)
+instead of the O(N*M) scan of a full argmin per point.
+"""
+import numpy as np
+
+
+def _searchsorted_rows(sorted_rows, queries):
+    # Row-wise np.searchsorted(side='left') for a 2-D stack of sorted rows.
+    # Each row is merged with its queries in one stable argsort; queries go
+    # first so ties land before equal data points, i.e. side='left'.
+    n_rows, n_data = sorted_rows.shape
+    queries = np.broadcast_to(queries, (n_rows, queries.shape[-1]))
+    merged = np.concatenate([queries, sorted_rows], axis=1)
+    order = np.argsort(merged, axis=1, kind='stable')
+    is_data = order >= queries.shape[1]
+    n_data_before = np.cumsum(is_data, axis=1) - is_data
+
+    positions = np.empty(queries.shape, dtype=int)
+    rows, cols = np.nonzero(~is_data)
+    positions[rows, order[rows, cols]] = n_data_before[rows, cols]
+    return positions
+
+
+def match_nearest(predicted_x, x):
+    """
+    Return the index of the predicted point nearest to each value of x.
+
+    Ties are resolved to the lowest index in predicted_x, which gives the
+    same answer as np.argmin(np.abs(predicted_x - x_val)) for every x_val.
+    predicted_x may be 1-D (M,) or a stack of curves (K, M); the result has
+    shape (N,) or (K, N) respectively.
+    """
+    predicted_x = np.asarray(predicted_x, dtype=float)
+    x = np.asarray(x, dtype=float)
+    single = predicted_x.ndim == 1
+    predicted_x = np.atleast_2d(predicted_x)
+    n_rows, n_points = predicted_x.shape
+    rows = np.arange(n_rows)[:, None]
+
+    # A stable sort keeps repeated x values in their original order, so the
+    # first element of a run of equal values is also the lowest index.
+    order = np.argsort(predicted_x, axis=1, kind='stable')
+    sorted_x = np.take_along_axis(predicted_x, order, axis=1)
+
+    if n_rows == 1:
+        upper = np.searchsorted(sorted_x[0], x)[None, :]
+    else:
+        upper = _searchsorted_rows(sorted_x, x)
+    lower = np.clip(upper - 1, 0, n_points - 1)
+    upper = np.clip(upper, 0, n_points - 1)
+
+    # Move the lower neighbour to the start of its run of equal values
+    if n_rows == 1:
+        lower = np.searchsorted(sorted_x[0], sorted_x[0, lower[0]])[None, :]
+    else:
+        lower = _searchsorted_rows(sorted_x, sorted_x[rows, lower])
+
+    lower_index = order[rows, lower]
+    upper_index = order[rows, upper]
+    lower_distance = np.abs(sorted_x[rows, lower] - x)
+    upper_distance = np.abs(sorted_x[rows, upper] - x)
+
+    take_upper = (upper_distance < lower_distance) | (
+        (upper_distance == lower_distance) & (upper_index < lower_index))
+    nearest = np.where(take_upper, upper_index, lower_index)
+
+    return nearest[0] if single else nearest
+
+
+def _match_y(predicted_backbone_x, predicted_backbone_y, backbone_x, backbone_y):
+    # The y of the predicted points nearest to each point of the backbone,
+    # of shape (N,) or (K, N) for a batch, and the backbone y
+    predicted_backbone_x = np.asarray(predicted_backbone_x, dtype=float)
+    predicted_backbone_y = np.asarray(predicted_backbone_y, dtype=float)
+    backbone_y = np.asarray(backbone_y, dtype=float)
+
+    nearest = match_nearest(predicted_backbone_x, backbone_x)
+    if predicted_backbone_y.ndim == 1:
+        return predicted_backbone_y[nearest], backbone_y
+    nearest = np.broadcast_to(
+        nearest, (predicted_backbone_y.shape[0], len(backbone_y)))
+    return np.take_along_axis(predicted_backbone_y, nearest, axis=1), backbone_y
+
+
+def calc_mae(predicted_backbone_x, predicted_backbone_y, backbone_x, backbone_y):
+    """
+    Mean absolute error between a backbone and the nearest points of a
+    predicted backbone.
+
+    The predicted backbone may also be a batch of candidates stacked into
+    2-D arrays of shape (K, M); predicted_backbone_x can be shared as a 1-D
+    array. A batch returns an array of K errors.
+    """
+    y_dense_matched, backbone_y = _match_y(predicted_backbone_x, predicted_backbone_y,
+                                           backbone_x, backbone_y)
+
+    # Calculate the Mean Absolute Error (MAE)
+    mae = np.mean(np.abs(y_dense_matched - backbone_y), axis=-1)
+
+    return mae
+
+
+def dissipated_energy(x, y):
+    """
+    The energy dissipated over a hysteresis, the integral of y dx with the
+    trapezoid rule. y may be a batch of shape (K, n) on a shared x.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    return np.sum((y[..., 1:] + y[..., :-1])*np.diff(x), axis=-1)/2
+
+
+METRICS = ('mae', 'rmse', 'max_error', 'peak_error', 'energy_error')
+
+
+def calc_metrics(predicted_backbone_x, predicted_backbone_y, backbone_x, backbone_y,
+                 predicted_energy=None, energy=None):
+    """
+    Every error in METRICS from one match of the predicted backbone to the
+    backbone.
+
+    mae is calc_mae, rmse and max_error the root mean square and largest of
+    the same errors, and peak_error the error at the peak strength of the
+    backbone. energy_error is the relative difference of the dissipated
+    energies, when both are given, and nan otherwise. As with calc_mae the
+    predicted backbone may be a batch of shape (K, M), in which case every
+    metric is an array of K values.
+    """
+    y_dense_matched, backbone_y = _match_y(predicted_backbone_x, predicted_backbone_y,
+                                           backbone_x, backbone_y)
+
+    errors = np.abs(y_dense_matched - backbone_y)
+    metrics = {
+        'mae': np.mean(errors, axis=-1),
+        'rmse': np.sqrt(np.mean(errors**2, axis=-1)),
+        'max_error': np.max(errors, axis=-1),
+        'peak_error': np.take(errors, np.argmax(backbone_y), axis=-1),
+        'energy_error': np.nan if errors.ndim == 1 else np.full(len(errors), np.nan),
+    }
+    if predicted_energy is not None and energy is not None:
+        metrics['energy_error'] = np.abs(np.asarray(predicted_energy) - energy)/abs(energy)
+
+    return metrics
@@ -5,30 +5,34 @@ Reference: Copyright Silvia Mazzoni, silviamazzoni@yahoo.com 2021
 https://opensees.github.io/OpenSeesDocumentation/user/manual/material/uniaxialMaterials/HystereticSM.html
 """
 import csv
+import os
 import openseespy.opensees as ops
-import matplotlib.pyplot as plt
 # ------------------
 #  initialize
 # ------------------
 import numpy as np
-import matplotlib.pyplot as plt
-import hysteresis as hys
+
+import instrumentation
 
 strainMap = {}
 
 
 def defineStrainHistory(peaksArray, scaleFactor, nSteps, nCycles):
-    strain = []
-    for thisPeak in peaksArray:
-        for i in range(nCycles):
-            strain = np.append(strain, np.linspace(
-                0, thisPeak*scaleFactor, nSteps))
-            strain = np.append(strain, np.linspace(
-                thisPeak*scaleFactor, -thisPeak*scaleFactor, nSteps))
-            strain = np.append(
-                strain, np.linspace(-thisPeak*scaleFactor, 0, nSteps))
+    """
+    Build the cyclic strain history 0 -> +peak -> -peak -> 0, repeated
+    nCycles times at each peak. The output size is known up front, so the
+    history is written into a single preallocated buffer.
+    """
+    amplitude = np.asarray(peaksArray, dtype=float)*scaleFactor
+
+    # Axes are (peak, cycle, half-cycle leg, step), flattened in that order
+    strain = np.empty((len(amplitude), nCycles, 3, nSteps))
+    strain[:, :, 0] = np.linspace(0, amplitude, nSteps, axis=1)[:, None]
+    strain[:, :, 1] = np.linspace(
+        amplitude, -amplitude, nSteps, axis=1)[:, None]
+    strain[:, :, 2] = np.linspace(-amplitude, 0, nSteps, axis=1)[:, None]
 
-    return strain
+    return strain.ravel()
 
 
 peaksArray = np.array([.5, 1, 1.5, 2, 2.5, 3, 3.5, 4, 4.5,
@@ -39,14 +43,12 @@ scaleFactor = 0.3
 nSteps = 60
 nCycles = 2
 strain = defineStrainHistory(peaksArray, scaleFactor, nSteps, nCycles)
-plt.plot(strain)
 strainMap['symmCycles'] = strain
 
-plt.savefig("strain.png")
-
 
 def formatAx(axModel, Title, xLabel, yLabel, titleFontSize=12, otherFontSize=12, legendLocation='best', backgroundColor='', legendFontSize=0, ncol=1):
     # Reference: Copyright Silvia Mazzoni, silviamazzoni@yahoo.com 2021
+    import matplotlib.pyplot as plt
     plt.rc('font', size=3)
     plt.rc('font', size=3)
     if legendFontSize == 0:
@@ -67,132 +69,307 @@ def formatAx(axModel, Title, xLabel, yLabel, titleFontSize=12, otherFontSize=12,
         axModel.set_facecolor(backgroundColor)
 
 
-OpenSeesMaterialBaseValues = {}
-OpenSeesMaterialDefaultValues = {}
+def defineMaterialValues(M1):
+    """
+    Build the HystereticSM material inputs, with the envelope scaled from M1.
+    Returns the base and default material dictionaries keyed by name.
+    """
+    OpenSeesMaterialBaseValues = {}
+    OpenSeesMaterialDefaultValues = {}
+    M2 = round(1.12*M1, 1)
+    M3 = round(0.6*M1, 1)
+    M4 = M3
+    M5 = round(0.1*M1, 1)
+    M6 = M5
+    M7 = 0.01*M1
+    eps1 = 0.1
+    eps2 = 2.*eps1
+    eps3 = 4.*eps1
+    eps4 = 6.*eps1
+    eps5 = 8.*eps1
+    eps6 = 10.*eps1
+    eps7 = 12.*eps1
+
+    limitStateInput = ['-defoLimitStates', eps1, -eps1,
+                       eps2, -eps2, '-forceLimitStates', M1, -M1, M2, -M2]
+    positiveEnvelope = [M1, eps1, M2, eps2, M3, eps3,
+                        M4, eps4, M5, eps5, 100., eps6, 0, eps7]
+    negativeEnvelope = [-M1, -eps1, -M2, -eps2, -M3, -eps3]
+
+    OpenSeesMaterialBaseValues[f'HystereticSM'] = [
+        'HystereticSM', '-posEnv', *positiveEnvelope, '-negEnv', *negativeEnvelope]
+    OpenSeesMaterialBaseValues[f'HystereticSMsymm'] = [
+        'HystereticSM', '-posEnv', *positiveEnvelope]
+
+    for thisPinch in [[1, 1], [.2, .8], [.8, .2]]:
+        OpenSeesMaterialDefaultValues[f'HystereticSM_pinch={thisPinch}'] = [
+            'HystereticSM', '-posEnv', *positiveEnvelope, '-negEnv', *negativeEnvelope, '-pinch', *thisPinch]
+    for thisDamage1 in [0, 0.01, 0.1]:
+        OpenSeesMaterialDefaultValues[f'HystereticSM_damage1={thisDamage1}'] = [
+            'HystereticSM', '-posEnv', *positiveEnvelope, '-negEnv', *negativeEnvelope, '-damage', thisDamage1, 0]
+    for thisDamage2 in [0, 0.01, 0.1]:
+        OpenSeesMaterialDefaultValues[f'HystereticSM_damage2={thisDamage2}'] = [
+            'HystereticSM', '-posEnv', *positiveEnvelope, '-negEnv', *negativeEnvelope, '-damage', 0, thisDamage2]
+    for thisBeta in [0, 0.5, 1]:
+        OpenSeesMaterialDefaultValues[f'HystereticSM_beta={thisBeta}'] = [
+            'HystereticSM', '-posEnv', *positiveEnvelope, '-negEnv', *negativeEnvelope, '-beta', thisBeta]
+    dmg1a = 0.005
+    dmg2a = 0.002
+    for thisDegEnv in [0, 1, 5]:
+        OpenSeesMaterialDefaultValues[f'HystereticSM_degEnv={thisDegEnv}'] = [
+            'HystereticSM', '-posEnv', *positiveEnvelope, '-negEnv', *negativeEnvelope, '-damage', dmg1a, dmg2a, '-degEnv', thisDegEnv, -thisDegEnv]
+
+    return OpenSeesMaterialBaseValues, OpenSeesMaterialDefaultValues
+
+
 M1 = 1784.2104208416836
-M2 = round(1.12*M1, 1)
-M3 = round(0.6*M1, 1)
-M4 = M3
-M5 = round(0.1*M1, 1)
-M6 = M5
-M7 = 0.01*M1
-eps1 = 0.1
-eps2 = 2.*eps1
-eps3 = 4.*eps1
-eps4 = 6.*eps1
-eps5 = 8.*eps1
-eps6 = 10.*eps1
-eps7 = 12.*eps1
-
-
-limitStateInput = ['-defoLimitStates', eps1, -eps1,
-                   eps2, -eps2, '-forceLimitStates', M1, -M1, M2, -M2]
-positiveEnvelope = [M1, eps1, M2, eps2, M3, eps3,
-                    M4, eps4, M5, eps5, 100., eps6, 0, eps7]
-negativeEnvelope = [-M1, -eps1, -M2, -eps2, -M3, -eps3]
-
-OpenSeesMaterialBaseValues[f'HystereticSM'] = [
-    'HystereticSM', '-posEnv', *positiveEnvelope, '-negEnv', *negativeEnvelope]
-OpenSeesMaterialBaseValues[f'HystereticSMsymm'] = [
-    'HystereticSM', '-posEnv', *positiveEnvelope]
-
-for thisPinch in [[1, 1], [.2, .8], [.8, .2]]:
-    OpenSeesMaterialDefaultValues[f'HystereticSM_pinch={thisPinch}'] = [
-        'HystereticSM', '-posEnv', *positiveEnvelope, '-negEnv', *negativeEnvelope, '-pinch', *thisPinch]
-for thisDamage1 in [0, 0.01, 0.1]:
-    OpenSeesMaterialDefaultValues[f'HystereticSM_damage1={thisDamage1}'] = [
-        'HystereticSM', '-posEnv', *positiveEnvelope, '-negEnv', *negativeEnvelope, '-damage', thisDamage1, 0]
-for thisDamage2 in [0, 0.01, 0.1]:
-    OpenSeesMaterialDefaultValues[f'HystereticSM_damage2={thisDamage2}'] = [
-        'HystereticSM', '-posEnv', *positiveEnvelope, '-negEnv', *negativeEnvelope, '-damage', 0, thisDamage2]
-for thisBeta in [0, 0.5, 1]:
-    OpenSeesMaterialDefaultValues[f'HystereticSM_beta={thisBeta}'] = [
-        'HystereticSM', '-posEnv', *positiveEnvelope, '-negEnv', *negativeEnvelope, '-beta', thisBeta]
-dmg1a = 0.005
-dmg2a = 0.002
-for thisDegEnv in [0, 1, 5]:
-    OpenSeesMaterialDefaultValues[f'HystereticSM_degEnv={thisDegEnv}'] = [
-        'HystereticSM', '-posEnv', *positiveEnvelope, '-negEnv', *negativeEnvelope, '-damage', dmg1a, dmg2a, '-degEnv', thisDegEnv, -thisDegEnv]
-
-
-AllStressStrain = {}
-
-Nmaterials = len(OpenSeesMaterialDefaultValues.keys())
-Ncols = 2
-Nrows = int(Nmaterials/Ncols)
-Nrows = 2
-
-figSizeH = 2*Ncols
-figSizeV = 2*Nrows
-DPI = 200
-
-thisCount = 0
-allStrainArray = ['symmCycles']
-iStrain = 0
-for thisStrainLabel in allStrainArray:
-    thisStrain = strainMap[thisStrainLabel]
-    iStrain += 1
-    iplt = 1
-    for thisMaterial in [list(OpenSeesMaterialDefaultValues.keys())[0]]:
-        print('--------------------------------------------')
-        # print(thisMaterial)
-        if iplt == 1:
-            figEach = plt.figure(f'Material Response Each {thisMaterial} {thisStrainLabel}', figsize=(
-                figSizeH, figSizeV), dpi=DPI, facecolor='w', edgecolor='k')
-        iplt += 1
-        axEach = figEach.add_subplot(Nrows, Ncols, iplt)
-
-        counter = thisCount + 1
+OpenSeesMaterialBaseValues, OpenSeesMaterialDefaultValues = defineMaterialValues(
+    M1)
+defaultMaterial = list(OpenSeesMaterialDefaultValues.keys())[0]
+
+
+class MaterialSession:
+    """
+    The OpenSees interpreter of one process, set up once and shared by every
+    simulation run in it.
+
+    Every material is defined under a new tag, so none starts from the state
+    another simulation left behind, and the interpreter is only wiped when
+    maxMaterials tags are in use. The strain history is converted to Python
+    floats once instead of for every simulation; it is recognised by
+    identity, so a history must not be changed in place once run.
+    """
+
+    def __init__(self, maxMaterials=1000):
+        self.maxMaterials = maxMaterials
+        self.pid = os.getpid()
+        self._strain = None
+        self._strainList = None
+        self.reset()
+
+    def reset(self):
+        ops.wipe()
+        self.nextTag = 1
+
+    def define(self, inputArray):
+        """
+        Define a material from an input list without a tag and return its tag.
+        """
+        if self.nextTag > self.maxMaterials:
+            self.reset()
+        try:
+            ops.uniaxialMaterial(inputArray[0], self.nextTag, *inputArray[1:])
+        except ops.OpenSeesError:
+            # The tag was taken by code outside the session, start over
+            self.reset()
+            ops.uniaxialMaterial(inputArray[0], self.nextTag, *inputArray[1:])
+        self.nextTag += 1
+        return self.nextTag - 1
+
+    def strain_list(self, strain):
+        if strain is not self._strain:
+            self._strain = strain
+            self._strainList = np.asarray(strain, dtype=float).tolist()
+        return self._strainList
+
+    def run(self, inputArray, strain):
+        """
+        The stress of a new material from inputArray over a strain history.
+        """
+        with instrumentation.stage('define material'):
+            tag = self.define(inputArray)
+        with instrumentation.stage('opensees'):
+            return drive_material(self.strain_list(strain), tag)
+
+
+_session = None
+
+
+def get_session():
+    """
+    The MaterialSession of this process, started on first use.
+    """
+    global _session
+    if _session is None or _session.pid != os.getpid():
+        _session = MaterialSession()
+    return _session
+
+
+def get_hysteresis(M1, material=defaultMaterial, strain=None, materialTag=None):
+    """
+    Run the strain history through an OpenSees material built from M1.
+
+    Parameters
+    ----------
+    M1 : float
+        The first force point of the envelope, the rest are scaled from it.
+    material : str, optional
+        A key of OpenSeesMaterialDefaultValues. The default is the first one.
+    strain : array, optional
+        The strain history to apply. The default is strainMap['symmCycles'].
+    materialTag : int, optional
+        Wipe the interpreter and define the material with this tag, instead
+        of running it in the session of this process.
+
+    Returns
+    -------
+    strain, stress : arrays
+        The applied strain and the resulting stress.
+    """
+    if strain is None:
+        strain = strainMap['symmCycles']
+    inputArray = defineMaterialValues(M1)[1][material]
+
+    if materialTag is None:
+        stress = get_session().run(inputArray, strain)
+    else:
         ops.wipe()
-        materialTag = 99
-
-        inputArray = OpenSeesMaterialDefaultValues[thisMaterial]
-
-        MaterialInput = inputArray[0], materialTag, *inputArray[1:]
-        # print(f'ops.uniaxialMaterial{MaterialInput}')
-        MaterialInputTcl = str(MaterialInput).replace(
-            ',', ' ').replace('(', '').replace(')', '').replace("'", '')
-        # print(f'uniaxialMaterial {MaterialInputTcl}')
-        ops.uniaxialMaterial(*MaterialInput)
-
-        ops.testUniaxialMaterial(materialTag)
-        stress = []
-        MUy = []
-        for eps in thisStrain:
-            ops.setStrain(eps)
-            stress.append(ops.getStress())
-            tangent = ops.getTangent()  # Not used
-
-        thisCount = len(list(AllStressStrain.keys()))
-        thisKey = 'Run' + str(thisCount+1) + ' ' + thisMaterial
-        AllStressStrain[thisKey] = {}
-        AllStressStrain[thisKey]['strain'] = thisStrain
-        AllStressStrain[thisKey]['stress'] = stress
-
-        with open("hysteresis.csv", "w", newline='') as f:
-            write = csv.writer(f)
-            write.writerow(["strain", "stress"])
-            for x, y in zip(thisStrain, stress):
-                write.writerow([x, y])
-
-        backbone_file = "SPC1.csv"
-        hysteresis_data = np.loadtxt(backbone_file, delimiter=',', skiprows=2)
-
-        # Sort the data into a xy curve
-        x = hysteresis_data[:, 1]*(1/280)
-        y = hysteresis_data[:, 0]*40
-        xy = np.column_stack([x, y])
-
-        # Make a hysteresis object
-        myHys = hys.Hysteresis(xy)
-
-        # Plot the object to see if cycles are tested properly
-        fig, ax = plt.subplots()
-        myHys.plot(label='Experiment Hysteresis')
-
-        MaterialInputStr = str(MaterialInput).replace(',', ',\n')
-        line, = ax.plot(AllStressStrain[thisKey]['strain'], AllStressStrain[thisKey]
-                        ['stress'], linewidth='1', label=MaterialInputStr, marker='', color="red")
-        formatAx(ax, thisMaterial, 'Strain,Rotation,Curvature, or Deformation',
-                 'Stress,Moment,Moment, or Force', 4, 4, 'best', 'lightgrey', 2)
-        plt.savefig("FINAL_Steel01_opensees_hysteresis.png")
+        ops.uniaxialMaterial(inputArray[0], materialTag, *inputArray[1:])
+        stress = drive_material(strain, materialTag)
+    instrumentation.count('strain steps', len(strain))
+
+    return strain, stress
+
+
+def drive_material(strain, materialTags, tangent=False):
+    """
+    Apply a whole strain history to one or more defined OpenSees materials.
+
+    Parameters
+    ----------
+    strain : array or list
+        The strain history to apply. A list of floats is used as it is.
+    materialTags : int or list of int
+        The tags of materials that have already been defined. Every tag is
+        driven through the same history in a single pass over the strain.
+    tangent : bool, optional
+        Also return the tangent at every step. Skipped by default, as
+        getTangent doubles the calls into OpenSees.
+
+    Returns
+    -------
+    stress : array
+        Shape (len(strain),) for a single tag, or (len(tags), len(strain)).
+    tangents : array
+        Only returned if tangent is True, with the same shape as stress.
+    """
+    # Bind the OpenSees calls locally and iterate over Python floats, this
+    # loop runs once per strain step so every lookup counts.
+    setStrain = ops.setStrain
+    getStress = ops.getStress
+    getTangent = ops.getTangent
+    if not isinstance(strain, list):
+        strain = np.asarray(strain, dtype=float).tolist()
+    Nstrain = len(strain)
+
+    tags = np.atleast_1d(materialTags).tolist()
+    if len(tags) == 1 and not tangent:
+        ops.testUniaxialMaterial(tags[0])
+        stress = np.fromiter((setStrain(eps) or getStress()
+                             for eps in strain), float, Nstrain)
+        stress = stress[None, :]
+    else:
+        # Each material keeps its own state, so the test material can be
+        # switched between tags at every step.
+        stress = np.empty((len(tags), Nstrain))
+        tangents = np.empty((len(tags), Nstrain)) if tangent else None
+        switchTags = len(tags) > 1
+        ops.testUniaxialMaterial(tags[0])
+        for i, eps in enumerate(strain):
+            for j, tag in enumerate(tags):
+                if switchTags:
+                    ops.testUniaxialMaterial(tag)
+                setStrain(eps)
+                stress[j, i] = getStress()
+                if tangent:
+                    tangents[j, i] = getTangent()
+
+    if np.ndim(materialTags) == 0:
+        stress = stress[0]
+        if tangent:
+            tangents = tangents[0]
+
+    if tangent:
+        return stress, tangents
+    return stress
+
+
+def main():
+    # The plotting libraries are only needed when run as a script, importing
+    # them here keeps the simulation API quick to import.
+    import matplotlib.pyplot as plt
+    import hysteresis as hys
+    from datasets import load_xy
+
+    plt.plot(strainMap['symmCycles'])
+    plt.savefig("strain.png")
+
+    AllStressStrain = {}
+
+    Nmaterials = len(OpenSeesMaterialDefaultValues.keys())
+    Ncols = 2
+    Nrows = int(Nmaterials/Ncols)
+    Nrows = 2
+
+    figSizeH = 2*Ncols
+    figSizeV = 2*Nrows
+    DPI = 200
+
+    thisCount = 0
+    allStrainArray = ['symmCycles']
+    iStrain = 0
+    for thisStrainLabel in allStrainArray:
+        thisStrain = strainMap[thisStrainLabel]
+        iStrain += 1
+        iplt = 1
+        for thisMaterial in [list(OpenSeesMaterialDefaultValues.keys())[0]]:
+            print('--------------------------------------------')
+            # print(thisMaterial)
+            if iplt == 1:
+                figEach = plt.figure(f'Material Response Each {thisMaterial} {thisStrainLabel}', figsize=(
+                    figSizeH, figSizeV), dpi=DPI, facecolor='w', edgecolor='k')
+            iplt += 1
+            axEach = figEach.add_subplot(Nrows, Ncols, iplt)
+
+            counter = thisCount + 1
+            materialTag = 99
+
+            inputArray = OpenSeesMaterialDefaultValues[thisMaterial]
+
+            MaterialInput = inputArray[0], materialTag, *inputArray[1:]
+            _, stress = get_hysteresis(M1, thisMaterial, thisStrain, materialTag)
+
+            thisCount = len(list(AllStressStrain.keys()))
+            thisKey = 'Run' + str(thisCount+1) + ' ' + thisMaterial
+            AllStressStrain[thisKey] = {}
+            AllStressStrain[thisKey]['strain'] = thisStrain
+            AllStressStrain[thisKey]['stress'] = stress
+
+            with open("hysteresis.csv", "w", newline='') as f:
+                write = csv.writer(f)
+                write.writerow(["strain", "stress"])
+                for x, y in zip(thisStrain, stress):
+                    write.writerow([x, y])
+
+            backbone_file = "SPC1.csv"
+
+            # Sort the data into a xy curve
+            xy = load_xy(backbone_file, yScale=40)
+
+            # Make a hysteresis object
+            myHys = hys.Hysteresis(xy)
+
+            # Plot the object to see if cycles are tested properly
+            fig, ax = plt.subplots()
+            myHys.plot(label='Experiment Hysteresis')
+
+            MaterialInputStr = str(MaterialInput).replace(',', ',\n')
+            line, = ax.plot(AllStressStrain[thisKey]['strain'], AllStressStrain[thisKey]
+                            ['stress'], linewidth='1', label=MaterialInputStr, marker='', color="red")
+            formatAx(ax, thisMaterial, 'Strain,Rotation,Curvature, or Deformation',
+                     'Stress,Moment,Moment, or Force', 4, 4, 'best', 'lightgrey', 2)
+            plt.savefig("FINAL_Steel01_opensees_hysteresis.png")
+
+
+if __name__ == "__main__":
+    main()
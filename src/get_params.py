@@ -3,7 +3,6 @@ Created on 5 April 2024
 @author: David Chan
 """
 
-import matplotlib.pyplot as plt
 import numpy as np
 import csv
 
@@ -22,6 +21,7 @@ theta_pc = -0.003 + 0.0007 * d
 
 
 def main():
+    import matplotlib.pyplot as plt
 
     strain_at_yield, Qy, x_Qmax, Qmax_prime, x_Qr, Qr_prime, x_int, theta_ult = get_parms()
 
@@ -75,7 +75,7 @@ def calc_strain_at_yield(Qy):
     return strain_at_yield
 
 
-def calc_Qy(area=0.0089):
+def calc_Qy(area=0.0089, Fye_kPa=Fye_kPa):
     # Equations based on provided parameters for cyclic backbone
     Qy = area * Fye_kPa  # Input cross-sectional area
     return Qy
@@ -127,12 +127,15 @@ def calc_segment(x1, y1, x2, y2):
     return (x_values, y_values)
 
 
-def get_parms(area=0.0089, theta_ult=0.05):
-    Qy = calc_Qy(area)
+def get_parms(area=0.0089, theta_ult=0.05, d=d, Fye=Fye):
+    # Every argument may also be an array, which gives the parameters of
+    # one backbone per element
+    Qy = calc_Qy(area, Fye * ksi_to_kPa)
     strain_at_yield = calc_strain_at_yield(Qy)
 
     # Parameters for the cyclic backbone
     theta_cap = 0.046 - 0.0013 * d  # Assuming 'd' is proportional to Fye for simplicity
+    theta_pc = -0.003 + 0.0007 * d
 
     Qmax_prime = calc_Qmax_prime(Qy)
 
@@ -159,14 +162,114 @@ def get_segments(strain_at_yield, Qy, x_Qmax, Qmax_prime, x_Qr, Qr_prime, x_int,
 
 
 def get_x_and_y(list_of_segments):
-    # Extract the x and y coordinates for plotting
-    x_values = []
-    y_values = []
-    for segment in list_of_segments:
-        x_values.extend(segment[0].tolist())
-        y_values.extend(segment[1].tolist())
+    # Extract the x and y coordinates for plotting, as arrays rather than
+    # lists of Python floats
+    x_values = np.concatenate([segment[0] for segment in list_of_segments])
+    y_values = np.concatenate([segment[1] for segment in list_of_segments])
     return x_values, y_values
 
 
+def calc_segments(x1, y1, x2, y2, num=100):
+    # calc_segment for arrays of end points, one row of num points per segment
+    x_values = np.linspace(x1, x2, num=num, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m = (y2 - y1) / (x2 - x1)
+        b = y1 - m * x1
+        y_values = m[:, None] * x_values + b[:, None]
+    vertical = (x2 - x1) == 0
+    y_values[vertical] = np.linspace(y1[vertical], y2[vertical], num=num, axis=-1)
+
+    return x_values, y_values
+
+
+class Backbone:
+    """
+    A piecewise-linear backbone stored as its vertices only.
+
+    The vertices are the origin, Qy, Qmax', Qint, Qr', LVCC1 and LVCC, for
+    one backbone (V,) or a batch of backbones (K, V). The backbone is
+    evaluated exactly at any deformation rather than through sampled points.
+
+    Parameters
+    ----------
+    x, y : array
+        The deformation and stress of every vertex, in order along the curve.
+    """
+
+    def __init__(self, x, y):
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+
+    @classmethod
+    def from_parms(cls, area=0.0089, theta_ult=0.05, d=d, Fye=Fye):
+        """
+        The backbones of get_parms, one per element of the broadcast arguments.
+        """
+        single = all(np.ndim(v) == 0 for v in (area, theta_ult, d, Fye))
+        area, theta_ult, d, Fye = [np.ravel(v).astype(float) for v in
+                                   np.broadcast_arrays(area, theta_ult, d, Fye)]
+        strain_at_yield, Qy, x_Qmax, Qmax_prime, x_Qr, Qr_prime, x_int, theta_ult = get_parms(
+            area, theta_ult, d, Fye)
+        zeros = np.zeros_like(Qy)
+
+        x = np.stack([zeros, strain_at_yield, x_Qmax, x_int, x_Qr, x_Qr,
+                      x_Qr + theta_ult*x_Qr], axis=1)
+        y = np.stack([zeros, Qy, Qmax_prime, Qr_prime, Qr_prime, zeros, zeros], axis=1)
+        return cls(x[0], y[0]) if single else cls(x, y)
+
+    def __len__(self):
+        return 1 if self.x.ndim == 1 else self.x.shape[0]
+
+    def __call__(self, x):
+        """
+        Evaluate the stress at the deformations x.
+
+        Where the curve doubles back over x, the first segment along the curve
+        is used, and outside the curve the stress of the nearest end vertex.
+        This is the limit of calc_mae's nearest-point match as the sampling
+        of the segments gets infinitely dense. Returns (N,) for one backbone
+        or (K, N) for a batch.
+        """
+        x = np.asarray(x, dtype=float)
+        vertex_x = np.atleast_2d(self.x)[:, :, None]
+        vertex_y = np.atleast_2d(self.y)[:, :, None]
+        rows = np.arange(vertex_x.shape[0])
+
+        last = np.argmax(vertex_x[:, :, 0], axis=1)
+        first = np.argmin(vertex_x[:, :, 0], axis=1)
+        y = np.where(x > vertex_x[rows, last], vertex_y[rows, last], vertex_y[rows, first])
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for k in range(vertex_x.shape[1] - 2, -1, -1):
+                x1, x2 = vertex_x[:, k], vertex_x[:, k + 1]
+                y1, y2 = vertex_y[:, k], vertex_y[:, k + 1]
+                inside = (x >= np.minimum(x1, x2)) & (x <= np.maximum(x1, x2))
+                segment_y = np.where(x2 == x1, y1, y1 + (x - x1)*(y2 - y1)/(x2 - x1))
+                y = np.where(inside, segment_y, y)
+
+        return y[0] if self.x.ndim == 1 else y
+
+    def mae(self, backbone_x, backbone_y):
+        """
+        Mean absolute error against a backbone, evaluated at exactly its x.
+        """
+        return np.mean(np.abs(self(backbone_x) - np.asarray(backbone_y, dtype=float)), axis=-1)
+
+    def sample(self, num=100):
+        """
+        The densely sampled x and y of get_segments, num points per segment.
+        """
+        vertex_x = np.atleast_2d(self.x)
+        vertex_y = np.atleast_2d(self.y)
+        segments = [calc_segments(vertex_x[:, k], vertex_y[:, k],
+                                  vertex_x[:, k + 1], vertex_y[:, k + 1], num)
+                    for k in range(vertex_x.shape[1] - 1)]
+        x_values = np.concatenate([segment[0] for segment in segments], axis=1)
+        y_values = np.concatenate([segment[1] for segment in segments], axis=1)
+        if self.x.ndim == 1:
+            return x_values[0], y_values[0]
+        return x_values, y_values
+
+
 if __name__ == "__main__":
     main()
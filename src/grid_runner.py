@@ -0,0 +1,99 @@
+"""
+Process-pool runner for grid searches.
+
+Every grid point is independent, so the candidates are split into contiguous
+chunks and each chunk is evaluated serially inside a worker process. OpenSees
+keeps one global interpreter per process (ops.wipe() clears all of it), so
+each worker owns its own interpreter and never shares state with another.
+Results are always returned in candidate order, which keeps the reduction to
+the minimum error deterministic regardless of the number of workers.
+
+While an instrumentation.Profile is active, each worker times its chunk
+with a Profile of its own and returns its state with the results, which is
+merged into the active Profile.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import openseespy.opensees as ops
+
+import instrumentation
+
+
+def _init_worker():
+    # Start every worker from a clean OpenSees interpreter
+    ops.wipe()
+
+
+def _evaluate_chunk(evaluate, chunk):
+    return [evaluate(candidate) for candidate in chunk]
+
+
+def _evaluate_chunk_profiled(evaluate, chunk, sample):
+    # sample counts from the first candidate of the chunk
+    with instrumentation.Profile(sample=sample, interval=None) as profile:
+        results = _evaluate_chunk(evaluate, chunk)
+    return results, profile.state()
+
+
+def run_grid(evaluate, candidates, workers=1, chunksize=None, onChunk=None):
+    """
+    Evaluate every candidate and return the results in candidate order.
+    See iter_grid for the parameters.
+    """
+    return list(iter_grid(evaluate, candidates, workers, chunksize, onChunk))
+
+
+def iter_grid(evaluate, candidates, workers=1, chunksize=None, onChunk=None):
+    """
+    Evaluate every candidate and yield the results in candidate order, each
+    chunk as soon as it and the chunks before it are done, so the caller can
+    reduce them without holding the results of the whole grid.
+
+    Parameters
+    ----------
+    evaluate : callable
+        A picklable function (module level, or a functools.partial of one)
+        that takes a single candidate and returns its result.
+    candidates : sequence
+        The grid points to evaluate.
+    workers : int, optional
+        The number of worker processes. 1 evaluates in this process and
+        0 uses every available core. The default is 1.
+    chunksize : int, optional
+        The number of candidates sent to a worker at a time. The default
+        gives each worker about four chunks to balance the load.
+    onChunk : callable, optional
+        Called with the number of candidates in each chunk a worker returns,
+        in this process, e.g. to report progress.
+    """
+    candidates = list(candidates)
+    if workers == 0:
+        workers = os.cpu_count()
+    if workers == 1 or len(candidates) <= 1:
+        for candidate in candidates:
+            yield evaluate(candidate)
+        return
+
+    if chunksize is None:
+        chunksize = max(1, len(candidates) // (4*workers))
+
+    profiled = instrumentation.worker_sample(0) is not False
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        futures = []
+        for start in range(0, len(candidates), chunksize):
+            chunk = candidates[start:start + chunksize]
+            if profiled:
+                futures.append(executor.submit(_evaluate_chunk_profiled, evaluate, chunk,
+                                               instrumentation.worker_sample(start)))
+            else:
+                futures.append(executor.submit(_evaluate_chunk, evaluate, chunk))
+        for i, future in enumerate(futures):
+            chunk = future.result()
+            futures[i] = None
+            if profiled:
+                chunk, state = chunk
+                instrumentation.merge(state)
+            if onChunk is not None:
+                onChunk(len(chunk))
+            yield from chunk
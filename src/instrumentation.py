@@ -0,0 +1,330 @@
+"""
+Timers and counters for the stages of a search.
+
+The simulation, backbone extraction and scoring code marks its stages with
+
+    with instrumentation.stage('opensees'):
+        ...
+
+or the @instrumentation.timed('backbone') decorator, and counts work with
+instrumentation.count(). These do nothing until a Profile is active:
+
+    with instrumentation.Profile(sample=10) as profile:
+        grid_search(backbone_x, backbone_y)
+    profile.dump('profile.json')
+
+While active, the Profile keeps the duration of every call of every stage,
+prints the candidates/s and the time left every few seconds, and runs
+cProfile and tracemalloc over the candidate numbered sample, or over the
+whole batch that holds it where candidates are simulated together. Only the
+process that activated the Profile records. Pool workers record into a
+Profile of their own for each chunk (see grid_runner), whose state comes back
+with the results and is merged into the active one; their candidates are
+counted through advance() as the chunks come back.
+"""
+import cProfile
+import csv
+import io
+import json
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+import numpy as np
+
+# Bin edges of the stage duration histograms, in seconds, fixed so that
+# profiles of different runs can be compared
+HISTOGRAM_EDGES = np.logspace(-6, 2, 17)
+
+_active = None
+_inactive = nullcontext()
+
+
+def _recording():
+    # The active profile, if this process is the one recording it
+    if _active is not None and _active.pid == os.getpid():
+        return _active
+    return None
+
+
+def stage(name):
+    """
+    Context manager timing a stage; free when no Profile is active.
+    """
+    profile = _recording()
+    if profile is None:
+        return _inactive
+    return profile.stage(name)
+
+
+def timed(name):
+    """
+    Decorator timing every call of a function as the stage name.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            profile = _recording()
+            if profile is None:
+                return function(*args, **kwargs)
+            with profile.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    profile = _recording()
+    if profile is not None:
+        profile.counters[name] += n
+
+
+def candidate():
+    """
+    Context manager around the evaluation of one candidate.
+    """
+    profile = _recording()
+    if profile is None:
+        return _inactive
+    return profile.candidate()
+
+
+def batch(n):
+    """
+    Context manager around the evaluation of the next n candidates at once,
+    which count themselves with advance().
+    """
+    profile = _recording()
+    if profile is None:
+        return _inactive
+    return profile.batch(n)
+
+
+def worker_sample(first):
+    """
+    The sample of a pool worker Profile whose candidates start first
+    candidates after the ones done, or False if no Profile is recording.
+    """
+    profile = _recording()
+    if profile is None:
+        return False
+    if profile.sample is None:
+        return None
+    return profile.sample - profile.done - first
+
+
+def merge(state):
+    """
+    Add the state of a pool worker Profile to the active one.
+    """
+    profile = _recording()
+    if profile is not None:
+        profile.merge(state)
+
+
+def advance(n=1):
+    """
+    Count n candidates evaluated elsewhere, e.g. by a pool worker.
+    """
+    profile = _recording()
+    if profile is not None:
+        profile.advance(n)
+
+
+def expect(total):
+    """
+    Set the number of candidates the search will evaluate, for the ETA.
+    """
+    profile = _recording()
+    if profile is not None:
+        profile.expect(total)
+
+
+class Profile:
+    """
+    Per-stage timings, counters and progress of a search.
+
+    Parameters
+    ----------
+    total : int, optional
+        The number of candidates expected. Searches that know it call
+        expect() instead.
+    sample : int, optional
+        The index of a candidate to run under cProfile and tracemalloc.
+    interval : float, optional
+        Seconds between progress lines, None for no progress lines.
+    stream : file, optional
+        Where the progress lines are written. The default is sys.stderr.
+    """
+
+    def __init__(self, total=None, sample=None, interval=5.0, stream=None):
+        self.total = total
+        self.sample = sample
+        self.interval = interval
+        self.stream = stream
+        self.pid = os.getpid()
+
+        self.durations = defaultdict(list)
+        self.counters = Counter()
+        self.done = 0
+        self.started = time.perf_counter()
+        self.lastReport = self.started
+        self.sampleStats = None
+        self.samplePeakKiB = None
+        self._previous = None
+
+    def __enter__(self):
+        global _active
+        self._previous = _active
+        _active = self
+        self.started = self.lastReport = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        _active = self._previous
+        self.elapsed = time.perf_counter() - self.started
+        return False
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name].append(time.perf_counter() - start)
+
+    @contextmanager
+    def candidate(self):
+        sampled = self._sampled() if self.done == self.sample else nullcontext()
+        with sampled, self.stage('candidate'):
+            yield
+        self.advance()
+
+    @contextmanager
+    def batch(self, n):
+        sampled = self.sample is not None and self.done <= self.sample < self.done + n
+        with self._sampled() if sampled else nullcontext(), self.stage('batch'):
+            yield
+
+    @contextmanager
+    def _sampled(self):
+        # Run under cProfile and tracemalloc, and keep their report
+        profiler = cProfile.Profile()
+        tracingMemory = tracemalloc.is_tracing()
+        if not tracingMemory:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        try:
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+        finally:
+            self.samplePeakKiB = tracemalloc.get_traced_memory()[1]/1024
+            if not tracingMemory:
+                tracemalloc.stop()
+            text = io.StringIO()
+            pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(25)
+            self.sampleStats = text.getvalue()
+
+    def state(self):
+        """
+        The stage durations, counters and sample report, for merge().
+        """
+        return {'durations': dict(self.durations), 'counters': dict(self.counters),
+                'sampleStats': self.sampleStats, 'samplePeakKiB': self.samplePeakKiB}
+
+    def merge(self, state):
+        """
+        Add the state() of another Profile, e.g. of a pool worker.
+        """
+        for name, durations in state['durations'].items():
+            self.durations[name].extend(durations)
+        self.counters.update(state['counters'])
+        if state['sampleStats'] is not None:
+            self.sampleStats = state['sampleStats']
+            self.samplePeakKiB = state['samplePeakKiB']
+
+    def expect(self, total):
+        self.total = total
+        self.done = 0
+        self.started = self.lastReport = time.perf_counter()
+
+    def advance(self, n=1):
+        self.done += n
+        now = time.perf_counter()
+        if self.interval is not None and (now - self.lastReport >= self.interval
+                                          or self.done == self.total):
+            self.lastReport = now
+            print(self.progress(), file=self.stream or sys.stderr)
+
+    def rate(self):
+        elapsed = time.perf_counter() - self.started
+        return self.done/elapsed if elapsed > 0 else 0.
+
+    def eta(self):
+        """
+        Seconds until the expected candidates are done, None if unknown.
+        """
+        rate = self.rate()
+        if self.total is None or rate == 0:
+            return None
+        return max(self.total - self.done, 0)/rate
+
+    def progress(self):
+        eta = self.eta()
+        total = '' if self.total is None else '/{}'.format(self.total)
+        left = '' if eta is None else ', {:.0f} s left'.format(eta)
+        return '{}{} candidates, {:.1f} candidates/s{}'.format(
+            self.done, total, self.rate(), left)
+
+    def summary(self):
+        """
+        Statistics of every stage, in seconds, with a duration histogram.
+        """
+        stages = {}
+        for name, durations in self.durations.items():
+            durations = np.array(durations)
+            stages[name] = {
+                'calls': len(durations),
+                'total': float(durations.sum()),
+                'mean': float(durations.mean()),
+                'min': float(durations.min()),
+                'p50': float(np.percentile(durations, 50)),
+                'p90': float(np.percentile(durations, 90)),
+                'max': float(durations.max()),
+                'histogram': np.histogram(durations, HISTOGRAM_EDGES)[0].tolist(),
+            }
+        return stages
+
+    def dump(self, filename):
+        """
+        Write the profile as json, or as a table of stages if filename ends
+        in .csv.
+        """
+        stages = self.summary()
+        if filename.endswith('.csv'):
+            columns = ['calls', 'total', 'mean', 'min', 'p50', 'p90', 'max']
+            with open(filename, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['stage'] + columns)
+                for name, statistics in stages.items():
+                    writer.writerow([name] + [statistics[column] for column in columns])
+            return
+
+        elapsed = getattr(self, 'elapsed', time.perf_counter() - self.started)
+        with open(filename, 'w') as f:
+            json.dump({'elapsed': elapsed, 'candidates': self.done,
+                       'candidates_per_second': self.done/elapsed if elapsed > 0 else 0.,
+                       'histogram_edges': HISTOGRAM_EDGES.tolist(),
+                       'stages': stages, 'counters': dict(self.counters),
+                       'sample': {'index': self.sample, 'peak_kib': self.samplePeakKiB,
+                                  'cprofile': self.sampleStats}},
+                      f, indent=4)
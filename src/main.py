@@ -3,15 +3,16 @@ import matplotlib.pyplot as plt
 import hysteresis as hys
 from sklearn.metrics import mean_absolute_error
 from get_params import get_segments, get_parms, get_x_and_y
+from error_metrics import calc_mae
+from datasets import load_xy
+from protocol import detect_LPsteps
+from backbone import get_backbone_curve
 
 def main():
     backbone_file = "SPC1.csv"
-    hysteresis_data = np.loadtxt(backbone_file, delimiter=',', skiprows=2)
 
     # Sort the data into a xy curve
-    x = hysteresis_data[:,1]*(1/280)
-    y = hysteresis_data[:,0]*100
-    xy = np.column_stack([x,y]) 
+    xy = load_xy(backbone_file)
 
     # Make a hysteresis object
     myHys = hys.Hysteresis(xy)
@@ -22,14 +23,14 @@ def main():
     plt.savefig("hysteresis.png")
 
     # count the number of repeats in each 'step' of the load protocol
-    LPsteps = [5,5,5,3,3,3,3]
+    LPsteps = detect_LPsteps(xy[:,0])
 
     # Make the backbone curve
-    backbone = hys.getBackboneCurve(myHys, LPsteps, returnPeaks=True)    
+    backbone = get_backbone_curve(xy, LPsteps, returnPeaks=True)
 
     #Plot
     fig, ax = plt.subplots()
-    backbone_data = backbone.plot(linestyle = '-.', label = 'Backbone')
+    backbone_data, = ax.plot(backbone[:,0], backbone[:,1], linestyle = '-.', label = 'Backbone')
     plt.minorticks_on()
     ax.grid(which='major', color='grey', linewidth=0.5, alpha = 0.8)
     ax.grid(which='minor', linewidth=0.5, alpha = 0.4)
@@ -56,16 +57,13 @@ def plot_opensees_backbone(steel_name):
     """
     There are [x] repeats at each load protocol step, and y steps in total.
     """
-    lpSteps = [3]*20
-
-    # Make the Hysteresis object
-    myHys = hys.Hysteresis(xy)
+    lpSteps = detect_LPsteps(xy[:,0])
 
     # Get the backbone
-    backbone = hys.getBackboneCurve(myHys, lpSteps)
+    backbone = get_backbone_curve(xy, lpSteps)
 
     fig, ax = plt.subplots()
-    backbone_data = backbone.plot(label='Analysis Backbone Data', color='red')
+    backbone_data, = ax.plot(backbone[:,0], backbone[:,1], label='Analysis Backbone Data', color='red')
 
     ax.set_xlabel('Deformation (mm/mm)')
     ax.set_ylabel('Stress (kPa)')
@@ -82,17 +80,5 @@ def plot_opensees_backbone(steel_name):
 
     return backbone_x,backbone_y
 
-def calc_mae(predicted_backbone_x, predicted_backbone_y, backbone_x, backbone_y):
-
-    # Find the closest x_dense points to each x_sparse point and their corresponding y values
-    y_dense_matched = np.array(
-        [predicted_backbone_y[np.argmin(np.abs(predicted_backbone_x - x_val))] for x_val in backbone_x])
-
-    # Calculate the Mean Absolute Error (MAE)
-    mae = np.mean(np.abs(y_dense_matched - backbone_y))
-
-    return mae
-
-
 if __name__ == "__main__":
     main()
\ No newline at end of file
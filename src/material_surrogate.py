@@ -0,0 +1,487 @@
+"""
+Pure-NumPy versions of the OpenSees uniaxial materials used in this project.
+
+Every function takes a single strain history and a batch of K parameter sets,
+and steps through the history once with the state of all K materials held in
+arrays, so a whole sweep of candidates is simulated in one pass.
+
+Stepping through the history costs the same few dozen NumPy calls per step
+whatever K is, which for a few hundred candidates is slower than OpenSees.
+HystereticSM is therefore stepped only at the first increment of each run of
+increments in one direction. Within the rest of the run the reload rules are
+fixed, and the stress follows s[i] = min(s[i-1] + a[i], h[i]), which is solved
+for the whole run at once with cumulative sums and minima.
+
+HystereticSM follows the OpenSees rules for the multi-point envelope, pinching
+(-pinch), ductility damage (-damage with damage2 = 0) and the unloading
+stiffness degradation (-beta). Energy damage and envelope degradation are not
+implemented, so the damage2 and degEnv families must be run with OpenSees.
+"""
+import numpy as np
+
+from get_hysteresis_data import defineMaterialValues, defaultMaterial, strainMap
+
+DBL_EPSILON = np.finfo(float).eps
+POS_INF_STRAIN = 1.0e16
+NEG_INF_STRAIN = -1.0e16
+
+
+def steel01_response(strain, Fy, E0, b):
+    """
+    Stress history of Steel01 without isotropic hardening.
+
+    Parameters
+    ----------
+    strain : array
+        The strain history, shared by every material.
+    Fy, E0, b : float or array
+        Yield stress, initial stiffness and strain hardening ratio. Arrays
+        of length K give K materials.
+
+    Returns
+    -------
+    stress : array
+        Shape (K, len(strain)).
+    """
+    strain = np.asarray(strain, dtype=float)
+    Fy, E0, b = np.broadcast_arrays(*np.atleast_1d(Fy, E0, b))
+    Fy, E0, b = [np.asarray(v, dtype=float) for v in (Fy, E0, b)]
+
+    fyOneMinusB = Fy*(1.0 - b)
+    Esh = b*E0
+
+    stress = np.empty((len(Fy), len(strain)))
+    Cstrain = 0.0
+    Cstress = np.zeros(len(Fy))
+    for i, eps in enumerate(strain):
+        dStrain = eps - Cstrain
+        if abs(dStrain) > DBL_EPSILON:
+            c = Cstress + E0*dStrain
+            c1 = Esh*eps
+            Cstress = np.maximum(np.minimum(c1 + fyOneMinusB, c), c1 - fyOneMinusB)
+        Cstrain = eps
+        stress[:, i] = Cstress
+
+    return stress
+
+
+def _envelope_points(values):
+    # Convert OpenSees "force, deformation" pairs into (K, n+1) arrays that
+    # start at the origin.
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    zeros = np.zeros((values.shape[0], 1))
+    rot = np.hstack([zeros, values[:, 1::2]])
+    mom = np.hstack([zeros, values[:, 0::2]])
+    return rot, mom
+
+
+def _envelope_stress(strain, rot, mom, sign):
+    # Piecewise-linear envelope. Past the last point the envelope continues
+    # on the last slope if it is positive, otherwise it holds the last value.
+    # strain holds one value per material, (K,), or a block of steps shared
+    # by every material, (1, B).
+    a = sign*strain
+    r = sign*rot
+    m = sign*mom
+    if a.ndim == 2:
+        r = r[:, :, None]
+        m = m[:, :, None]
+    n = r.shape[1] - 1
+
+    slope = (m[:, n] - m[:, n-1])/(r[:, n] - r[:, n-1])
+    stress = np.where(slope > 0, m[:, n-1] + slope*(a - r[:, n-1]), m[:, n])
+    for k in range(n, 0, -1):
+        slope = (m[:, k] - m[:, k-1])/(r[:, k] - r[:, k-1])
+        stress = np.where(a <= r[:, k], m[:, k-1] + slope*(a - r[:, k-1]), stress)
+
+    return sign*np.where(a <= 0, 0.0, stress)
+
+
+def _envelope_zero_crossing(rot, mom, sign, default):
+    # The deformation at which the envelope first drops to zero force
+    r = sign*rot
+    m = sign*mom
+    crossing = np.full(r.shape[0], default)
+    for k in range(r.shape[1] - 1, 0, -1):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            atZero = r[:, k-1] - m[:, k-1]*(r[:, k] - r[:, k-1])/(m[:, k] - m[:, k-1])
+        crossing = np.where(m[:, k] <= 0, sign*atZero, crossing)
+    return crossing
+
+
+def _reload_state(Cstrain, Cstress, CrotMax, CrotMin, CrotNu, CmaxMom, reverse, side):
+    # The trial state of an increment towards the positive envelope, and the
+    # unloading and reloading stiffnesses. Increments towards the negative
+    # envelope use the same rules with every sign flipped and the two
+    # envelopes swapped, see side.
+    rot1p, rot1n, E1p, E1n, rotlim, pinchX, pinchY, damage1, beta, envelope = side
+
+    if beta is None:
+        kn = kp = 1.0
+    else:
+        kn = (CrotMin/rot1n)**beta
+        kn = np.where(kn < 1.0, 1.0, 1.0/kn)
+        kp = (CrotMax/rot1p)**beta
+        kp = np.where(kp < 1.0, 1.0, 1.0/kp)
+
+    TrotNu = np.where(reverse, Cstrain - Cstress/(E1n*kn), CrotNu)
+    if damage1 is None:
+        TrotMax = np.where(CrotMax > rot1p, CrotMax, rot1p)
+        maxmom = CmaxMom
+    else:
+        damfc = np.where(CrotMin < rot1n, damage1*(CrotMin - rot1n)/rot1n, 0.0)
+        TrotMax = np.where(reverse, CrotMax*(1.0 + damfc), CrotMax)
+        TrotMax = np.where(TrotMax > rot1p, TrotMax, rot1p)
+        maxmom = envelope(TrotMax)
+    rotrel = np.where(rotlim > TrotNu, rotlim, TrotNu)
+    rotmp2 = TrotMax - (1.0 - pinchY)*maxmom/(E1p*kp)
+    rotch = rotrel + (rotmp2 - rotrel)*pinchX
+
+    return TrotNu, TrotMax, maxmom, rotrel, rotch, E1n*kn, E1p*kp
+
+
+def _reload(eps, dStrain, Cstrain, Cstress, CrotMax, CrotMin, CrotNu, CmaxMom,
+            reverse, side):
+    # An increment of strain towards the positive envelope, from inside the
+    # envelopes
+    pinchY = side[6]
+    TrotNu, TrotMax, maxmom, rotrel, rotch, Eunload, Eload = _reload_state(
+        Cstrain, Cstress, CrotMax, CrotMin, CrotNu, CmaxMom, reverse, side)
+
+    unload = Cstress + Eunload*dStrain
+    unload = np.where(unload >= 0.0, 0.0, unload)
+    elastic = Cstress + Eload*dStrain
+    pinched = (eps - rotrel)*maxmom*pinchY/(rotch - rotrel)
+    pinched = np.where(eps <= rotrel, 0.0,
+                       np.where(elastic < pinched, elastic, pinched))
+    reload = pinchY*maxmom + (eps - rotch)*(1.0 - pinchY)*maxmom/(TrotMax - rotch)
+    reload = np.where(elastic < reload, elastic, reload)
+    Tstress = np.where(eps < TrotNu, unload,
+                       np.where(eps < rotch, pinched, reload))
+
+    return Tstress, TrotMax, TrotNu, maxmom
+
+
+def _reload_run(eps, dStrain, Cstress, CrotMax, CrotMin, CrotNu, CmaxMom, envelope, side):
+    # The increments eps (L,) towards the positive envelope that follow the
+    # first increment of a run in that direction, given the envelope stress
+    # at each of them, (K, L). Every material is either inside the envelopes
+    # with the reload state of the first increment, or on the envelope until
+    # the run ends.
+    rot1p, pinchY = side[0], side[6][:, None]
+    reverse = np.zeros(len(Cstress), dtype=bool)
+    TrotNu, TrotMax, maxmom, rotrel, rotch, Eunload, Eload = [
+        v[:, None] for v in _reload_state(0.0, Cstress, CrotMax, CrotMin, CrotNu, CmaxMom,
+                                          reverse, side)]
+
+    # Each branch of _reload as s[i] = min(s[i-1] + increment[i], limit[i]),
+    # except where the pinched branch releases the stress to zero
+    unloading = eps < TrotNu
+    pinching = ~unloading & (eps < rotch)
+    released = pinching & (eps <= rotrel)
+    increment = np.where(unloading, Eunload*dStrain, Eload*dStrain)
+    increment[released] = 0.0
+    pinched = (eps - rotrel)*maxmom*pinchY/(rotch - rotrel)
+    reload = pinchY*maxmom + (eps - rotch)*(1.0 - pinchY)*maxmom/(TrotMax - rotch)
+    limit = np.where(unloading, 0.0, np.where(pinching, pinched, reload))
+
+    # s[i] = total[i] + min(s[-1], min over j <= i of limit[j] - total[j]),
+    # started again from zero after the stress is released. eps grows over
+    # the run, so each branch covers one range of increments.
+    total = np.cumsum(increment, axis=1)
+    bound = limit - total
+    stress = total + np.minimum(Cstress[:, None], np.minimum.accumulate(bound, axis=1))
+    afterRelease = np.logical_or.accumulate(released, axis=1)
+    restarted = np.where(afterRelease, np.where(released, -total, bound), np.inf)
+    stress = np.where(afterRelease, total + np.minimum.accumulate(restarted, axis=1), stress)
+
+    onEnvelope = eps >= CrotMax[:, None]
+    stress = np.where(onEnvelope, envelope, stress)
+
+    inside = ~onEnvelope[:, 0]
+    reached = onEnvelope[:, -1]
+    CrotMax = np.where(reached, eps[-1], np.where(inside, TrotMax[:, 0], CrotMax))
+    CrotNu = np.where(inside, TrotNu[:, 0], CrotNu)
+    CmaxMom = np.where(inside, maxmom[:, 0], CmaxMom)
+    CmaxMom = np.where(reached & (eps[-1] > rot1p), envelope[:, -1], CmaxMom)
+    return stress, CrotMax, CrotNu, CmaxMom, inside
+
+
+def hysteretic_sm_response(strain, posEnv, negEnv, pinch=(1, 1), damage1=0, beta=0):
+    """
+    Stress history of HystereticSM.
+
+    Parameters
+    ----------
+    strain : array
+        The strain history, shared by every material.
+    posEnv, negEnv : array
+        The envelopes as OpenSees "force, deformation" pairs, either one list
+        or a (K, 2*n) array for K materials. Every material in a batch needs
+        the same number of points.
+    pinch : tuple of float or arrays, optional
+        The pinchX and pinchY factors.
+    damage1 : float or array, optional
+        Ductility damage factor.
+    beta : float or array, optional
+        Power for the degraded unloading stiffness.
+
+    Returns
+    -------
+    stress : array
+        Shape (K, len(strain)).
+    """
+    strain = np.asarray(strain, dtype=float)
+    rotP, momP = _envelope_points(posEnv)
+    rotN, momN = _envelope_points(negEnv)
+    K = max(rotP.shape[0], rotN.shape[0])
+    rotP, momP, rotN, momN = [np.broadcast_to(v, (K, v.shape[1]))
+                              for v in (rotP, momP, rotN, momN)]
+    pinchX, pinchY, damage1, beta = [np.broadcast_to(np.asarray(v, dtype=float), (K,))
+                                     for v in (pinch[0], pinch[1], damage1, beta)]
+
+    # HystereticSM unloads on the steepest slope of each envelope, which is
+    # only steeper than the first branch for envelopes that stiffen again.
+    rot1p, rot1n = rotP[:, 1], rotN[:, 1]
+    mom1p, mom1n = momP[:, 1], momN[:, 1]
+    E1p = np.max(np.diff(momP, axis=1)/np.diff(rotP, axis=1), axis=1)
+    E1n = np.max(np.diff(momN, axis=1)/np.diff(rotN, axis=1), axis=1)
+    rotlimP = _envelope_zero_crossing(rotP, momP, 1, POS_INF_STRAIN)
+    rotlimN = _envelope_zero_crossing(rotN, momN, -1, NEG_INF_STRAIN)
+
+    # Skip the damage and stiffness degradation terms when they are unused
+    damage1 = damage1 if np.any(damage1 != 0) else None
+    beta = beta if np.any(beta != 0) else None
+
+    positiveSide = (rot1p, rot1n, E1p, E1n, rotlimN, pinchX, pinchY, damage1, beta,
+                    lambda rot: _envelope_stress(rot, rotP, momP, 1))
+    negativeSide = (-rot1n, -rot1p, E1n, E1p, -rotlimP, pinchX, pinchY, damage1, beta,
+                    lambda rot: _envelope_stress(rot, -rotN, -momN, 1))
+
+    # Committed state. Every material sees the same strain, so the strain and
+    # the direction of each increment are shared. CmaxMom and CminMom cache
+    # the envelope force at the largest deformations reached.
+    started = False
+    Cstrain = 0.0
+    Cstress = np.zeros(K)
+    CrotMax = np.zeros(K)
+    CrotMin = np.zeros(K)
+    CrotPu = np.zeros(K)
+    CrotNu = np.zeros(K)
+    CmaxMom = mom1p.copy()
+    CminMom = mom1n.copy()
+    CloadIndicator = np.zeros(K, dtype=int)
+
+    # The runs of increments in one direction, the steps of each run after
+    # the first are solved together. Increments below DBL_EPSILON are skipped
+    # by HystereticSM and end a run.
+    increments = np.diff(strain, prepend=0.0)
+    direction = np.where(np.abs(increments) < DBL_EPSILON, 0, np.sign(increments))
+    runEnds = np.append(np.flatnonzero(direction[1:] != direction[:-1]) + 1, len(strain))
+
+    stress = np.empty((K, len(strain)))
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        i = 0
+        while i < len(strain):
+            eps = strain[i]
+            dStrain = eps - Cstrain
+            if (not started and eps == 0.0) or abs(dStrain) < DBL_EPSILON:
+                Cstrain = eps if started else Cstrain
+                stress[:, i] = Cstress
+                i += 1
+                continue
+            if not started:
+                CloadIndicator[:] = 2 if dStrain < 0.0 else 1
+                started = True
+
+            posStress = _envelope_stress(strain[None, i:i + 1], rotP, momP, 1)[:, 0]
+            negStress = _envelope_stress(strain[None, i:i + 1], rotN, momN, -1)[:, 0]
+            onPosEnvelope = eps >= CrotMax
+            onNegEnvelope = ~onPosEnvelope & (eps <= CrotMin)
+            inside = ~onPosEnvelope & ~onNegEnvelope
+
+            if dStrain > 0.0:
+                reverse = (CloadIndicator == 2) & (Cstress <= 0.0)
+                Tstress, TrotMax, TrotNu, maxmom = _reload(
+                    eps, dStrain, Cstrain, Cstress, CrotMax, CrotMin, CrotNu,
+                    CmaxMom, reverse, positiveSide)
+                CrotMax = np.where(inside, TrotMax, CrotMax)
+                CrotNu = np.where(inside, TrotNu, CrotNu)
+                CmaxMom = np.where(inside, maxmom, CmaxMom)
+                CloadIndicator = np.where(inside, 1, CloadIndicator)
+            else:
+                reverse = (CloadIndicator == 1) & (Cstress >= 0.0)
+                Tstress, TrotMin, TrotPu, minmom = _reload(
+                    -eps, -dStrain, -Cstrain, -Cstress, -CrotMin, -CrotMax, -CrotPu,
+                    -CminMom, reverse, negativeSide)
+                Tstress = -Tstress
+                CrotMin = np.where(inside, -TrotMin, CrotMin)
+                CrotPu = np.where(inside, -TrotPu, CrotPu)
+                CminMom = np.where(inside, -minmom, CminMom)
+                CloadIndicator = np.where(inside, 2, CloadIndicator)
+
+            # Loading past the largest deformations follows the envelopes
+            Cstress = np.where(onPosEnvelope, posStress,
+                               np.where(onNegEnvelope, negStress, Tstress))
+            CrotMax = np.where(onPosEnvelope, eps, CrotMax)
+            CmaxMom = np.where(onPosEnvelope & (eps > rot1p), posStress, CmaxMom)
+            CrotMin = np.where(onNegEnvelope, eps, CrotMin)
+            CminMom = np.where(onNegEnvelope & (eps < rot1n), negStress, CminMom)
+            Cstrain = eps
+            stress[:, i] = Cstress
+
+            # The rest of the run, if it continues in the direction of this step
+            end = runEnds[np.searchsorted(runEnds, i, side='right')]
+            i += 1
+            if end <= i or direction[i] != np.sign(dStrain):
+                continue
+            run = strain[i:end]
+            if dStrain > 0.0:
+                envelope = _envelope_stress(run[None, :], rotP, momP, 1)
+                runStress, CrotMax, CrotNu, CmaxMom, inside = _reload_run(
+                    run, increments[i:end], Cstress, CrotMax, CrotMin, CrotNu, CmaxMom,
+                    envelope, positiveSide)
+                CloadIndicator = np.where(inside, 1, CloadIndicator)
+            else:
+                envelope = _envelope_stress(run[None, :], rotN, momN, -1)
+                runStress, TrotMin, TrotPu, minmom, inside = _reload_run(
+                    -run, -increments[i:end], -Cstress, -CrotMin, -CrotMax, -CrotPu,
+                    -CminMom, -envelope, negativeSide)
+                runStress = -runStress
+                CrotMin, CrotPu, CminMom = -TrotMin, -TrotPu, -minmom
+                CloadIndicator = np.where(inside, 2, CloadIndicator)
+            stress[:, i:end] = runStress
+            Cstress = runStress[:, -1]
+            Cstrain = run[-1]
+            i = end
+
+    return stress
+
+
+def parse_material(inputArray):
+    """
+    Split an OpenSees uniaxialMaterial input list, without the tag, into the
+    material name and a dictionary of its options.
+    """
+    name = inputArray[0]
+    if name == 'Steel01':
+        return name, {'Fy': inputArray[1], 'E0': inputArray[2], 'b': inputArray[3]}
+
+    options = {}
+    flag = None
+    for value in inputArray[1:]:
+        if isinstance(value, str):
+            flag = value
+            options[flag] = []
+        else:
+            options[flag].append(value)
+    return name, options
+
+
+def material_response(strain, inputArrays):
+    """
+    Stress history for a batch of OpenSees material input lists of the same
+    family, e.g. the values of OpenSeesMaterialDefaultValues for many M1.
+    """
+    parsed = [parse_material(inputArray) for inputArray in inputArrays]
+    names = set(name for name, _ in parsed)
+    if len(names) != 1:
+        raise ValueError('A batch must use a single material, got {}'.format(names))
+    name = names.pop()
+
+    if name == 'Steel01':
+        Fy, E0, b = np.array([[o['Fy'], o['E0'], o['b']] for _, o in parsed]).T
+        return steel01_response(strain, Fy, E0, b)
+    if name != 'HystereticSM':
+        raise ValueError('The surrogate does not implement {}'.format(name))
+
+    flags = set(tuple(sorted(o)) for _, o in parsed)
+    if len(flags) != 1:
+        raise ValueError('Every material in a batch needs the same options')
+    options = [o for _, o in parsed]
+    unsupported = set(options[0]) - {'-posEnv', '-negEnv', '-pinch', '-damage', '-beta'}
+    if any(o.get('-damage', [0, 0])[1] != 0 for o in options):
+        unsupported.add('-damage (damage2)')
+    if unsupported:
+        raise ValueError('The surrogate does not implement {}'.format(sorted(unsupported)))
+
+    posEnv = np.array([o['-posEnv'] for o in options], dtype=float)
+    negEnv = np.array([o.get('-negEnv', -np.array(o['-posEnv'])) for o in options],
+                      dtype=float)
+    pinch = np.array([o.get('-pinch', [1, 1]) for o in options], dtype=float).T
+    damage1 = np.array([o.get('-damage', [0, 0])[0] for o in options], dtype=float)
+    beta = np.array([o.get('-beta', [0])[0] for o in options], dtype=float)
+
+    return hysteretic_sm_response(strain, posEnv, negEnv, pinch, damage1, beta)
+
+
+def get_hysteresis_batch(M1s, material=defaultMaterial, strain=None):
+    """
+    The batched equivalent of get_hysteresis: one row of stress per M1.
+    """
+    if strain is None:
+        strain = strainMap['symmCycles']
+    inputArrays = [defineMaterialValues(M1)[1][material] for M1 in M1s]
+    return strain, material_response(strain, inputArrays)
+
+
+def validate(inputArrays, strain=None, reference=None, atol=1e-6):
+    """
+    Compare the surrogate against OpenSees and return the largest absolute
+    stress error, raising a ValueError if it is above atol.
+
+    Parameters
+    ----------
+    inputArrays : list
+        OpenSees material input lists, without tags.
+    strain : array, optional
+        The strain history. Read from the reference file if one is given,
+        otherwise strainMap['symmCycles'].
+    reference : str, optional
+        A "strain, stress" csv of OpenSees output to compare against
+        instead of running OpenSees, for a single material.
+    atol : float, optional
+        The allowed absolute stress error.
+    """
+    if reference is not None:
+        expected = np.loadtxt(reference, delimiter=',', skiprows=1)
+        strain = expected[:, 0]
+        expected = expected[None, :, 1]
+    else:
+        import openseespy.opensees as ops
+        from get_hysteresis_data import drive_material
+
+        if strain is None:
+            strain = strainMap['symmCycles']
+        ops.wipe()
+        for tag, inputArray in enumerate(inputArrays, start=1):
+            ops.uniaxialMaterial(inputArray[0], tag, *inputArray[1:])
+        expected = drive_material(strain, list(range(1, len(inputArrays) + 1)))
+
+    error = np.max(np.abs(material_response(strain, inputArrays) - expected))
+    if error > atol:
+        raise ValueError(
+            'The surrogate differs from OpenSees by {} (atol={})'.format(error, atol))
+    return error
+
+
+# The material that produced Steel01hysteresis.csv, the HystereticSM envelope
+# of get_hysteresis_data with M1 = 2772, eps1 = 0.01 and M6 = 200.
+Steel01ReferenceMaterial = [
+    'HystereticSM',
+    '-posEnv', 2772., 0.01, 3104.6, 0.02, 1663.2, 0.04, 1663.2, 0.06,
+    277.2, 0.08, 200., 0.1, 0, 0.12,
+    '-negEnv', -2772., -0.01, -3104.6, -0.02, -1663.2, -0.04,
+    '-pinch', 1, 1]
+
+
+if __name__ == "__main__":
+    error = validate([Steel01ReferenceMaterial], reference="Steel01hysteresis.csv")
+    print("Steel01hysteresis.csv: ", error)
+
+    supported = [key for key in defineMaterialValues(1)[1]
+                 if 'damage2' not in key and 'degEnv' not in key]
+    for thisMaterial in supported:
+        inputArrays = [defineMaterialValues(M1)[1][thisMaterial]
+                       for M1 in np.linspace(1, 5000, num=20)]
+        print(thisMaterial, ": ", validate(inputArrays))
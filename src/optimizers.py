@@ -0,0 +1,162 @@
+"""
+Optimizers that fit material parameters to a backbone with few simulations.
+
+Every optimizer minimises an objective that takes the parameters and returns
+(error, x_values, y_values), the same result as
+compare_backbones.evaluate_candidate. Each one stops after `budget`
+simulations and returns the best point found in the mins layout used by
+compare_backbones.grid_search:
+
+    [error, parameters, x_values, y_values, index, hysteresis]
+
+where index is the number of the simulation that found the minimum.
+The hysteresis is left as 0 for the caller to rebuild, as only the winner's is
+needed.
+"""
+import numpy as np
+from scipy.optimize import minimize, minimize_scalar
+
+
+class BudgetExhausted(Exception):
+    pass
+
+
+class Evaluations:
+    """
+    Counts the simulations run for an objective and tracks the best one.
+
+    Parameters are memoised, so revisiting a point costs nothing against the
+    budget. evaluate_many, if given, takes a list of parameters and returns a
+    list of results, which lets a batch of points be simulated together by a
+    process pool or the NumPy surrogate.
+    """
+
+    def __init__(self, objective, budget, evaluate_many=None):
+        self.objective = objective
+        self.evaluate_many = evaluate_many
+        self.budget = budget
+        self.count = 0
+        self.errors = {}
+        self.mins = [float('inf'), 0, 0, 0, 0, 0]
+
+    @staticmethod
+    def _key(params):
+        return tuple(np.atleast_1d(params).astype(float).tolist())
+
+    def _record(self, params, result):
+        error = float(result[0])
+        self.errors[self._key(params)] = error
+        if error < self.mins[0]:
+            self.mins[:5] = [error, params, result[1], result[2], self.count]
+        self.count += 1
+        return error
+
+    def __call__(self, params):
+        key = self._key(params)
+        if key not in self.errors:
+            if self.count >= self.budget:
+                raise BudgetExhausted
+            self._record(params, self.objective(params))
+        return self.errors[key]
+
+    def many(self, paramsList):
+        """
+        Return the error of every point, simulating the new ones together.
+        Points past the budget are returned as inf.
+        """
+        new, newKeys = [], set()
+        for params in paramsList:
+            key = self._key(params)
+            if key not in self.errors and key not in newKeys:
+                new.append(params)
+                newKeys.add(key)
+        new = new[:max(0, self.budget - self.count)]
+
+        if self.evaluate_many is None:
+            results = [self.objective(params) for params in new]
+        else:
+            results = self.evaluate_many(new) if new else []
+        for params, result in zip(new, results):
+            self._record(params, result)
+
+        return [self.errors.get(self._key(params), float('inf')) for params in paramsList]
+
+
+def coarse_to_fine(objective, bounds, budget=60, num=11, xtol=1e-4, evaluate_many=None):
+    """
+    Refine a 1-D grid around its best point until the spacing is below
+    xtol times the width of bounds or the budget is spent.
+
+    Parameters
+    ----------
+    objective : callable
+        Takes a float, returns (error, x_values, y_values).
+    bounds : tuple
+        The (lower, upper) search range.
+    budget : int, optional
+        The largest number of simulations.
+    num : int, optional
+        The number of points in every grid.
+    xtol : float, optional
+        The relative spacing to stop at.
+    evaluate_many : callable, optional
+        Simulates a list of points at once, see Evaluations.
+    """
+    evaluations = Evaluations(objective, budget, evaluate_many)
+    lower, upper = bounds
+    width = upper - lower
+
+    while evaluations.count < budget:
+        grid = np.linspace(lower, upper, num)
+        errors = evaluations.many(list(grid))
+        best = int(np.argmin(errors))
+        lower = grid[max(best - 1, 0)]
+        upper = grid[min(best + 1, num - 1)]
+        if upper - lower < xtol*width:
+            break
+
+    return evaluations.mins
+
+
+def brent(objective, bounds, budget=30, xtol=1e-4):
+    """
+    Bounded Brent search (golden section with parabolic steps) for a
+    unimodal 1-D objective. The arguments are as for coarse_to_fine.
+    """
+    evaluations = Evaluations(objective, budget)
+    lower, upper = bounds
+    try:
+        minimize_scalar(evaluations, bounds=bounds, method='bounded',
+                        options={'maxiter': budget, 'xatol': xtol*(upper - lower)})
+    except BudgetExhausted:
+        pass
+
+    return evaluations.mins
+
+
+def nelder_mead(objective, x0, bounds=None, budget=100, xtol=1e-4, ftol=1e-6):
+    """
+    Nelder-Mead simplex search for several parameters.
+
+    Parameters
+    ----------
+    objective : callable
+        Takes an array of parameters, returns (error, x_values, y_values).
+    x0 : array
+        The starting point.
+    bounds : list of tuple, optional
+        (lower, upper) for every parameter.
+    budget : int, optional
+        The largest number of simulations.
+    xtol, ftol : float, optional
+        Absolute tolerances on the parameters and the error.
+    """
+    evaluations = Evaluations(objective, budget)
+    try:
+        minimize(lambda params: evaluations(params.copy()), np.asarray(x0, dtype=float),
+                 method='Nelder-Mead', bounds=bounds,
+                 options={'maxfev': budget, 'xatol': xtol, 'fatol': ftol})
+    except BudgetExhausted:
+        pass
+
+    return evaluations.mins
@@ -0,0 +1,111 @@
+"""
+Pareto front of candidates scored on several metrics.
+
+A grid search keeps the single best candidate on one error. Scoring every
+candidate on all of error_metrics.METRICS and keeping the ones no other
+candidate beats on every metric at once lets the fit be chosen afterwards,
+for any metric or trade off, without simulating again.
+"""
+import numpy as np
+
+
+def dominates(a, b):
+    """
+    True if scores a are no worse than b on every metric and better on one.
+    """
+    a = np.asarray(a)
+    b = np.asarray(b)
+    return bool(np.all(a <= b) and np.any(a < b))
+
+
+def non_dominated(scores, blockSize=256):
+    """
+    The indexes, in order, of the rows of scores no other row dominates,
+    keeping only the first of equal rows. Metrics that are nan in every row
+    are left out, other nan count as the worst score.
+
+    Every row is compared with every other at once, blockSize rows at a time
+    to bound the memory of the comparison.
+    """
+    scores = np.asarray(scores, dtype=float)
+    if len(scores) == 0:
+        return np.empty(0, dtype=int)
+    scores = scores[:, ~np.all(np.isnan(scores), axis=0)]
+    scores = np.where(np.isnan(scores), np.inf, scores)
+
+    _, first = np.unique(scores, axis=0, return_index=True)
+    first = np.sort(first)
+    unique = scores[first, None, :]
+    dominated = np.empty(len(first), dtype=bool)
+    for start in range(0, len(first), blockSize):
+        block = unique[None, start:start + blockSize, 0, :]
+        dominates = np.all(unique <= block, axis=2) & np.any(unique < block, axis=2)
+        dominated[start:start + blockSize] = np.any(dominates, axis=0)
+    return first[~dominated]
+
+
+class ParetoFront:
+    """
+    The non-dominated candidates, all metrics being minimised.
+
+    Parameters
+    ----------
+    metrics : sequence of str
+        The names of the metrics each candidate is scored on. Metrics that
+        are nan for every candidate, such as an energy error without the
+        energies, are left out of the comparison.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = list(metrics)
+        self.candidates = []
+        self.scores = np.empty((0, len(self.metrics)))
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def add(self, candidate, scores):
+        """
+        Add a candidate with its scores (a dict by metric name) and return
+        True if it is on the front.
+        """
+        return bool(self.extend([candidate], [scores])[0])
+
+    def extend(self, candidates, scores):
+        """
+        Add many candidates at once and return, for each, True if it is on
+        the front. scores is a dict by metric name of arrays of a score per
+        candidate, as calc_metrics gives for a batch, or a dict per candidate.
+        The front is the same as that of adding them one at a time.
+        """
+        candidates = list(candidates)
+        if isinstance(scores, dict):
+            rows = np.column_stack([np.broadcast_to(np.asarray(scores[metric], dtype=float),
+                                                    len(candidates))
+                                    for metric in self.metrics])
+        else:
+            rows = np.array([[score[metric] for metric in self.metrics] for score in scores],
+                            dtype=float).reshape(-1, len(self.metrics))
+
+        allScores = np.vstack([self.scores, rows])
+        allCandidates = self.candidates + candidates
+        kept = non_dominated(allScores)
+        onFront = np.isin(np.arange(len(self.candidates), len(allCandidates)), kept)
+        self.candidates = [allCandidates[i] for i in kept]
+        self.scores = allScores[kept]
+        return onFront
+
+    def best(self, metric):
+        """
+        The candidate of the front with the lowest value of metric, and its
+        scores.
+        """
+        i = int(np.argmin(self.scores[:, self.metrics.index(metric)]))
+        return self.candidates[i], dict(zip(self.metrics, self.scores[i]))
+
+    def items(self):
+        """
+        The candidates of the front with their scores, by the first metric.
+        """
+        order = np.argsort(self.scores[:, 0], kind='stable')
+        return [(self.candidates[i], dict(zip(self.metrics, self.scores[i]))) for i in order]
@@ -0,0 +1,386 @@
+"""
+The whole comparison as one command, run as a graph of stages.
+
+    python -m pipeline --record SPC1.csv --workers 0
+
+replaces running get_hysteresis_data.py, get_params.py and
+compare_backbones.py by hand. Each stage reads the outputs of the stages it
+depends on from the output directory and writes its own there:
+
+    experiment   the xy of the record                    experiment.npy
+    simulate     the backbone of every M1 of the grid    simulated_backbones.npz
+    nist         the NIST backbone of get_params         nist_backbone.npy
+    extract      the experimental backbone and LPsteps   experimental_backbone.npz
+    score        the MAE of every M1 and of NIST         scores.json
+    report       the figures of the best M1              *.png
+
+A stage is skipped when its fingerprint matches the last run and its outputs
+are unchanged. The fingerprint is the sha256 of its options, its source and
+that of every module of the project it runs, directly or through other
+modules, and the outputs it reads. As it covers the
+outputs read rather than whether a stage ran, a stage that runs again but
+writes the same files leaves the stages after it up to date. Stages whose inputs are
+ready run at the same time in a process pool, so simulate, nist and
+experiment, then extract, overlap. The pool is only started once a stage has
+to run.
+"""
+import argparse
+import ast
+import hashlib
+import importlib.util
+import inspect
+import json
+import os
+import time
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from datasets import load_xy, _file_hash, _write_atomic
+
+STATE_FILE = 'pipeline.json'
+
+
+def run_experiment(inputs, outputs, options):
+    xy = np.asarray(load_xy(options['record']), dtype=float)
+    _write_atomic(outputs[0], lambda f: np.save(f, xy), mode='wb')
+
+
+def run_simulate(inputs, outputs, options):
+    from compare_backbones import get_cached_backbone
+    from grid_runner import run_grid
+    from result_store import ResultStore
+
+    M1s = np.linspace(options['lower'], options['upper'], num=options['num'])
+    simulate = partial(get_cached_backbone, material=options['material'])
+    backbones = run_grid(simulate, M1s, options['workers'])
+    # float64, so that the scores equal those of compare_backbones
+    store = ResultStore(dtype=float)
+    for M1, (x_values, y_values) in zip(M1s, backbones):
+        store.append(M1, np.nan, x_values, y_values)
+    with store:
+        _write_atomic(outputs[0], store.save, mode='wb')
+
+
+def run_nist(inputs, outputs, options):
+    from get_params import get_parms, get_segments, get_x_and_y
+
+    backbone = np.column_stack(get_x_and_y(get_segments(*get_parms())))
+    _write_atomic(outputs[0], lambda f: np.save(f, backbone), mode='wb')
+
+
+def run_extract(inputs, outputs, options):
+    from backbone import get_backbone_curve
+    from protocol import detect_LPsteps
+
+    xy = np.load(inputs['experiment'][0])
+    LPsteps = detect_LPsteps(xy[:, 0])
+    backbone = get_backbone_curve(xy, LPsteps, returnPeaks=True)
+    _write_atomic(outputs[0], lambda f: np.savez(f, backbone=backbone, LPsteps=LPsteps),
+                  mode='wb')
+
+
+def run_score(inputs, outputs, options):
+    from error_metrics import calc_mae
+    from result_store import ResultStore
+
+    with np.load(inputs['extract'][0]) as data:
+        backbone = data['backbone']
+    nist = np.load(inputs['nist'][0])
+    with ResultStore.load(inputs['simulate'][0]) as store:
+        errors = calc_mae(store.x, store.y[:len(store)], backbone[:, 0], backbone[:, 1])
+        best = int(np.argmin(errors))
+        scores = {'M1': float(store.candidates[best]), 'mae': float(errors[best]),
+                  'index': best, 'nist_mae': float(calc_mae(nist[:, 0], nist[:, 1],
+                                                            backbone[:, 0], backbone[:, 1])),
+                  'M1s': store.candidates[:len(store)].tolist(), 'errors': errors.tolist()}
+    _write_atomic(outputs[0], lambda f: json.dump(scores, f, indent=1))
+    print("Error: ", scores['mae'], " M1: ", scores['M1'], " NIST error: ", scores['nist_mae'])
+
+
+def run_report(inputs, outputs, options):
+    from get_hysteresis_data import get_hysteresis
+    from reporting import render_figures, hysteresis_figure, comparison_figure
+    from result_store import ResultStore
+
+    xy = np.load(inputs['experiment'][0])
+    with np.load(inputs['extract'][0]) as data:
+        backbone = data['backbone']
+    nist = np.load(inputs['nist'][0])
+    with open(inputs['score'][0]) as f:
+        scores = json.load(f)
+    with ResultStore.load(inputs['simulate'][0]) as store:
+        _, _, x_values, y_values = store[scores['index']]
+
+    experimental = (backbone[:, 0], backbone[:, 1])
+    render_figures([
+        (hysteresis_figure, (xy, outputs[0])),
+        (comparison_figure, ([experimental, (x_values, y_values)], outputs[1])),
+        (comparison_figure, ([experimental, (nist[:, 0], nist[:, 1])], outputs[2])),
+        (hysteresis_figure, (np.column_stack(get_hysteresis(scores['M1'], options['material'])),
+                             outputs[3])),
+    ], options['workers'])
+
+
+class Stage:
+    """
+    A step of the pipeline.
+
+    Parameters
+    ----------
+    run : callable
+        A module level function run(inputs, outputs, options), where inputs
+        maps each dependency to its output paths and outputs are the paths
+        to write.
+    dependencies : tuple of str
+        The stages whose outputs are read.
+    outputs : tuple of str
+        The files written, relative to the output directory.
+    options : tuple of str
+        The options that change the outputs.
+    files : tuple of str
+        The options naming files whose name and content change the outputs.
+    modules : tuple of str
+        The modules whose source changes the outputs, besides those run
+        imports. The modules of the project these import, directly or not,
+        are found by project_modules.
+    """
+
+    def __init__(self, run, dependencies=(), outputs=(), options=(), files=(), modules=()):
+        self.run = run
+        self.dependencies = dependencies
+        self.outputs = outputs
+        self.options = options
+        self.files = files
+        self.modules = modules
+
+
+STAGES = {
+    'experiment': Stage(run_experiment, (), ('experiment.npy',), files=('record',),
+                        modules=('datasets',)),
+    'simulate': Stage(run_simulate, (), ('simulated_backbones.npz',),
+                      ('lower', 'upper', 'num', 'material')),
+    'nist': Stage(run_nist, (), ('nist_backbone.npy',)),
+    'extract': Stage(run_extract, ('experiment',), ('experimental_backbone.npz',)),
+    'score': Stage(run_score, ('simulate', 'nist', 'extract'), ('scores.json',)),
+    'report': Stage(run_report, ('experiment', 'simulate', 'nist', 'extract', 'score'),
+                    ('hysteresis.png', 'best_backbone.png', 'nist_backbone.png',
+                     'best_hysteresis.png'), ('material',)),
+}
+
+
+def _imports(source, filename='<stage>'):
+    # The top level names of every module imported anywhere in source,
+    # including inside functions
+    names = set()
+    for node in ast.walk(ast.parse(source, filename)):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names.add(node.module.split('.')[0])
+    return names
+
+
+def project_modules(names):
+    """
+    The paths, by name, of the modules of names that are part of this
+    project, and of every module of the project they import, directly or
+    not. The imports are read from the source, nothing is imported.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    modules = {}
+    stack = list(names)
+    while stack:
+        name = stack.pop()
+        if name in modules:
+            continue
+        spec = importlib.util.find_spec(name)
+        if spec is None or spec.origin is None or not spec.origin.endswith('.py'):
+            continue
+        if os.path.dirname(os.path.abspath(spec.origin)) != directory:
+            continue
+        modules[name] = spec.origin
+        with open(spec.origin, 'rb') as f:
+            stack.extend(_imports(f.read(), spec.origin))
+    return modules
+
+
+def fingerprint(name, options, inputHashes):
+    """
+    The sha256 of a stage's options, its input files, its source and that of
+    its modules, and the hashes of the outputs of its dependencies.
+    """
+    stage = STAGES[name]
+    source = inspect.getsource(stage.run)
+    modules = project_modules(set(stage.modules) | _imports(source))
+    digest = hashlib.sha256()
+    digest.update(json.dumps([name, source,
+                              {option: options[option] for option in stage.options},
+                              {option: [os.path.basename(options[option]),
+                                        _file_hash(options[option])] for option in stage.files},
+                              {module: _file_hash(path) for module, path in modules.items()},
+                              {dependency: inputHashes[dependency]
+                               for dependency in stage.dependencies}],
+                             sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def get_needed(targets):
+    """
+    The targets and every stage they depend on.
+    """
+    needed = set()
+    stack = list(targets)
+    while stack:
+        name = stack.pop()
+        if name not in STAGES:
+            raise ValueError("Unknown stage '{}'".format(name))
+        if name not in needed:
+            needed.add(name)
+            stack.extend(STAGES[name].dependencies)
+    return needed
+
+
+def _run_stage(name, directory, inputs, options):
+    # Runs in a worker, so returns the time itself
+    start = time.perf_counter()
+    stage = STAGES[name]
+    stage.run(inputs, [os.path.join(directory, output) for output in stage.outputs], options)
+    return time.perf_counter() - start
+
+
+def run_pipeline(options, targets=None, directory='pipeline', jobs=0, force=()):
+    """
+    Run the stages of targets, and those they depend on, that are out of date.
+
+    Parameters
+    ----------
+    options : dict
+        record, material, lower, upper, num and workers, as the command line.
+    targets : list of str, optional
+        The stages wanted. The default is every stage.
+    directory : str, optional
+        Where the outputs and the fingerprints of the last run are kept.
+    jobs : int, optional
+        The number of stages run at once, 0 runs every ready stage at once
+        and 1 runs them in order in this process.
+    force : sequence of str, optional
+        Stages to run even if they are up to date.
+
+    Returns
+    -------
+    ran : list of str
+        The stages that were run, in the order they finished.
+    """
+    needed = get_needed(targets or list(STAGES))
+    os.makedirs(directory, exist_ok=True)
+    statePath = os.path.join(directory, STATE_FILE)
+    state = {}
+    if os.path.exists(statePath):
+        with open(statePath) as f:
+            state = json.load(f)
+
+    def output_hashes(name):
+        paths = [os.path.join(directory, output) for output in STAGES[name].outputs]
+        if not all(os.path.exists(path) for path in paths):
+            return None
+        return [_file_hash(path) for path in paths]
+
+    pending = set(needed)
+    hashes = {}
+    fingerprints = {}
+    ran = []
+    running = {}
+    # Started with the first stage that is out of date
+    executor = None
+    try:
+        while pending or running:
+            for name in sorted(pending):
+                stage = STAGES[name]
+                if not all(dependency in hashes for dependency in stage.dependencies):
+                    continue
+                pending.remove(name)
+                fingerprints[name] = fingerprint(name, options, hashes)
+                last = state.get(name, {})
+                if (name not in force and last.get('fingerprint') == fingerprints[name]
+                        and last.get('outputs') == output_hashes(name)):
+                    hashes[name] = last['outputs']
+                    print("{:<10} up to date".format(name))
+                    continue
+
+                inputs = {dependency: [os.path.join(directory, output)
+                                       for output in STAGES[dependency].outputs]
+                          for dependency in stage.dependencies}
+                if jobs == 1:
+                    running[name] = _run_stage(name, directory, inputs, options)
+                else:
+                    if executor is None:
+                        executor = ProcessPoolExecutor(max_workers=jobs or len(STAGES))
+                    running[name] = executor.submit(_run_stage, name, directory, inputs,
+                                                    options)
+            if not running:
+                # Every ready stage was up to date, look again for the next
+                continue
+
+            if jobs == 1:
+                finished = list(running)
+            else:
+                done, _ = wait(running.values(), return_when=FIRST_COMPLETED)
+                finished = [name for name, future in running.items() if future in done]
+            for name in finished:
+                result = running.pop(name)
+                seconds = result if jobs == 1 else result.result()
+                hashes[name] = output_hashes(name)
+                state[name] = {'fingerprint': fingerprints[name], 'outputs': hashes[name]}
+                # Kept after every stage, so a failed run resumes after it
+                _write_atomic(statePath, lambda f: json.dump(state, f, indent=1))
+                ran.append(name)
+                print("{:<10} ran in {:.2f} s".format(name, seconds))
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return ran
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m pipeline",
+        description="Compare the OpenSees and NIST backbones with a record, "
+                    "running only the stages that are out of date")
+    parser.add_argument("targets", nargs="*",
+                        help="stages to bring up to date, by default all of them: "
+                             + ", ".join(STAGES))
+    parser.add_argument("--record", default="SPC1.csv", help="the experimental csv")
+    parser.add_argument("--material", default=None,
+                        help="a key of OpenSeesMaterialDefaultValues, by default the first")
+    parser.add_argument("--lower", type=float, default=1, help="the lowest M1 of the grid")
+    parser.add_argument("--upper", type=float, default=5000, help="the highest M1 of the grid")
+    parser.add_argument("--num", type=int, default=500, help="the number of M1 in the grid")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes for the grid and the figures, 0 uses every core")
+    parser.add_argument("--jobs", type=int, default=0,
+                        help="stages run at once, 0 runs every ready stage and 1 runs "
+                             "them in order")
+    parser.add_argument("--directory", default="pipeline",
+                        help="where the outputs and their fingerprints are kept")
+    parser.add_argument("--force", nargs="*", default=(), choices=list(STAGES),
+                        help="stages to run even if they are up to date")
+    args = parser.parse_args(argv)
+
+    material = args.material
+    if material is None:
+        from get_hysteresis_data import defaultMaterial
+        material = defaultMaterial
+    options = {'record': os.path.abspath(args.record), 'material': material,
+               'lower': args.lower, 'upper': args.upper, 'num': args.num,
+               'workers': args.workers}
+    try:
+        get_needed(args.targets)
+    except ValueError as error:
+        parser.error(str(error))
+    run_pipeline(options, args.targets, args.directory, args.jobs, args.force)
+
+
+if __name__ == "__main__":
+    main()
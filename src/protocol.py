@@ -0,0 +1,88 @@
+"""
+Detection of the load protocol of a displacement history.
+
+getBackboneCurve needs LPsteps, the number of cycles at each amplitude step
+of the load protocol, to pick the first cycle of every step. Here the steps
+are found from the history itself. The positive reversals are found with the
+same rule as backbone.get_reversals, so that sensor noise is left out of
+both the steps and the backbone. A new step starts wherever a peak goes
+beyond every earlier peak, measured from the first sample, where the
+specimen is at rest; the cycles that follow at the same or a smaller
+amplitude are repeats of that step. This covers protocols with equal repeats
+and ones whose repeats are smaller than the first excursion, like SPC1, and
+records that do not start at zero.
+"""
+import numpy as np
+
+from backbone import NOISE, get_reversals
+
+# A step with more than this many times the median number of cycles of the
+# steps is taken as a failed detection
+MAX_STEP_RATIO = 4
+
+
+def get_step_peaks(x, noise=NOISE):
+    """
+    The x of the positive reversals between the first and last points, in
+    the order getBackboneCurve counts them.
+    """
+    x = np.asarray(x, dtype=float)
+    reversalX = x[get_reversals(x, noise)[:-1]]
+    return reversalX[1:][np.diff(reversalX) >= 0]
+
+
+def detect_LPsteps(x, rtol=0.02, noise=NOISE):
+    """
+    Return the number of cycles at each step of the load protocol of x.
+
+    Parameters
+    ----------
+    x : array
+        The displacement (or strain) history.
+    rtol : float, optional
+        A peak must exceed every earlier peak by this fraction to start a new
+        step, so that noise between repeated cycles is ignored.
+    noise : float, optional
+        Excursions smaller than this fraction of the range of x are neither
+        reversals nor new steps, as in backbone.get_reversals.
+
+    Raises
+    ------
+    ValueError
+        If a step has far more cycles than the others, as when noise is
+        taken as cycles. LPsteps must then be given.
+    """
+    x = np.asarray(x, dtype=float)
+    if len(x) == 0:
+        return []
+    # A noise excursion moves a peak by up to half of it
+    LPsteps = group_step_peaks(get_step_peaks(x, noise), rtol, x[0], noise*np.ptp(x)/2)
+    check_LPsteps(LPsteps)
+    return LPsteps
+
+
+def check_LPsteps(LPsteps):
+    """
+    Raise a ValueError if a step of detected LPsteps has more than
+    MAX_STEP_RATIO times the median number of cycles, as when noise is
+    taken as cycles.
+    """
+    if len(LPsteps) > 1 and max(LPsteps) > MAX_STEP_RATIO*np.median(LPsteps):
+        raise ValueError('A step of {} cycles in LPsteps {} is far longer than the others, '
+                         'the protocol was not detected'.format(max(LPsteps), LPsteps))
+
+
+def group_step_peaks(peaks, rtol=0.02, origin=0., atol=0.):
+    """
+    The number of cycles at each step, from the step peaks of get_step_peaks.
+    The amplitude of a peak is measured from origin, and a new step must
+    exceed every earlier amplitude by at least atol as well as rtol.
+    """
+    amplitudes = np.asarray(peaks, dtype=float) - origin
+    if len(amplitudes) == 0:
+        return []
+
+    previousMax = np.maximum.accumulate(amplitudes)[:-1]
+    threshold = previousMax + np.maximum(rtol*np.abs(previousMax), atol)
+    starts = np.concatenate([[0], np.nonzero(amplitudes[1:] > threshold)[0] + 1])
+    return np.diff(np.append(starts, len(amplitudes))).tolist()
@@ -0,0 +1,258 @@
+"""
+Warm-start recalibration of M1 as an experimental record grows.
+
+Specimens are often retested or extended with more cycles. Rather than
+repeating the search, the state of the last calibration is kept in a file:
+
+    - the StreamingBackbone of the rows read so far, so that only the
+      appended rows have to be reduced to find the new backbone peaks,
+    - the simulated backbone of every M1 tried, which do not depend on the
+      experiment,
+    - the error of every M1 at every experimental backbone point.
+
+When the record has grown, the load protocol is detected again from the
+stream, the backbone points that changed are scored against the stored
+simulations, and the MAE of every M1 is updated from the stored and the new
+errors. The search then only refines M1 between the neighbours of the new
+best, instead of the full range. A record with no rows appended, or whose
+appended rows leave the backbone as it was, is not searched again.
+
+    python recalibration.py SPC1.csv --state SPC1.calibration
+
+The state is a pickle, only load files written by this module.
+"""
+import argparse
+import copy
+import hashlib
+import os
+import pickle
+from functools import partial
+
+import numpy as np
+
+from compare_backbones import get_cached_backbone
+from datasets import load_xy, _write_atomic
+from error_metrics import match_nearest
+from get_hysteresis_data import defaultMaterial
+from grid_runner import run_grid
+from optimizers import brent
+from backbone import NOISE
+from protocol import check_LPsteps, group_step_peaks
+from streaming import StreamingBackbone
+
+
+def _prefix_hash(xy, nRows):
+    return hashlib.sha256(np.ascontiguousarray(xy[:nRows], dtype=float).tobytes()).hexdigest()
+
+
+class CalibrationState:
+    """
+    Everything a calibration of M1 to one record needs to be resumed.
+
+    Attributes
+    ----------
+    nRows : int
+        The rows of the record read so far.
+    backbone : array
+        The experimental backbone of those rows, shape (N, 2).
+    M1s : array
+        Every M1 simulated, shape (C,).
+    simX, simY : arrays
+        The x of the simulated backbones, shared by all of them, and the y of
+        each, shape (C, M).
+    errors : array
+        The absolute error of every M1 at every backbone point, shape (C, N).
+    """
+
+    def __init__(self, filename, material=defaultMaterial):
+        self.filename = os.path.basename(filename)
+        self.material = material
+        self.nRows = 0
+        self.prefixHash = _prefix_hash(np.empty((0, 2)), 0)
+        self.stream = StreamingBackbone(returnPeaks=True)
+        self.LPsteps = []
+        self.backbone = np.empty((0, 2))
+        self.M1s = np.empty(0)
+        self.simX = None
+        self.simY = None
+        self.errors = np.empty((0, 0))
+
+    def extends(self, filename, xy, material):
+        """
+        True if xy is the record of this state with rows appended.
+        """
+        return (os.path.basename(filename) == self.filename and material == self.material
+                and len(xy) >= self.nRows and _prefix_hash(xy, self.nRows) == self.prefixHash)
+
+    @property
+    def mae(self):
+        return np.mean(self.errors, axis=1)
+
+    def best(self):
+        """
+        The best MAE and its M1.
+        """
+        i = int(np.argmin(self.mae))
+        return float(self.mae[i]), float(self.M1s[i])
+
+    def append_rows(self, xy):
+        """
+        Read the rows of xy past nRows and rescore the backbone points that
+        changed.
+
+        Raises a ValueError, leaving the state as it was, if the load
+        protocol is not detected, as protocol.detect_LPsteps.
+        """
+        # The noise tolerance of the whole record, as detect_LPsteps. If the
+        # range grew, the rows read so far are streamed again with it.
+        tolerance = NOISE*np.ptp(xy[:, 0]) if len(xy) else 0.
+        if getattr(self.stream, 'tolerance', None) == tolerance:
+            stream = copy.deepcopy(self.stream)
+            stream.update(xy[self.nRows:])
+        else:
+            stream = StreamingBackbone(returnPeaks=True, tolerance=tolerance)
+            stream.update(xy)
+
+        # The last cycle is only closed on a copy, the stream goes on.
+        # Amplitudes from the first sample, where the specimen is at rest.
+        finished = copy.deepcopy(stream)
+        finished.finish()
+        LPsteps = group_step_peaks(finished.step_peaks(), origin=finished.reversals[0][1],
+                                   atol=tolerance/2)
+        check_LPsteps(LPsteps)
+        backbone = finished.select(LPsteps)
+
+        self.stream = stream
+        self.LPsteps = LPsteps
+        self.nRows = len(xy)
+        self.prefixHash = _prefix_hash(xy, self.nRows)
+
+        previous = {tuple(point): j for j, point in enumerate(self.backbone.tolist())}
+        kept = [previous.get(tuple(point)) for point in backbone.tolist()]
+        errors = np.empty((len(self.M1s), len(backbone)))
+        changed = [j for j, k in enumerate(kept) if k is None]
+        for j, k in enumerate(kept):
+            if k is not None:
+                errors[:, j] = self.errors[:, k]
+        self.backbone = backbone
+        if len(self.M1s):
+            errors[:, changed] = self._point_errors(self.simY, backbone[changed])
+        self.errors = errors
+        return len(changed)
+
+    def add_candidates(self, M1s, workers=1, chunksize=None):
+        """
+        Simulate M1s and score them on the current backbone.
+        """
+        simulate = partial(get_cached_backbone, material=self.material)
+        backbones = run_grid(simulate, list(M1s), workers, chunksize)
+        if self.simX is None:
+            self.simX = backbones[0][0]
+            self.simY = np.empty((0, len(self.simX)))
+        simY = np.array([y_values for _, y_values in backbones])
+
+        self.M1s = np.concatenate([self.M1s, M1s])
+        self.simY = np.vstack([self.simY, simY])
+        self.errors = np.vstack([self.errors, self._point_errors(simY, self.backbone)])
+
+    def _point_errors(self, simY, points):
+        # The error of each simulated backbone at each point, as in calc_mae
+        nearest = match_nearest(self.simX, points[:, 0])
+        return np.abs(simY[:, nearest] - points[:, 1])
+
+    def refine(self, budget=12):
+        """
+        Search M1 between the neighbours of the best M1 simulated so far.
+        """
+        order = np.argsort(self.M1s)
+        position = int(np.flatnonzero(order == np.argmin(self.mae))[0])
+        lower = self.M1s[order[max(position - 1, 0)]]
+        upper = self.M1s[order[min(position + 1, len(order) - 1)]]
+        if upper <= lower:
+            return
+
+        def objective(M1):
+            self.add_candidates([float(M1)])
+            return self.mae[-1], self.simX, self.simY[-1]
+
+        brent(objective, (lower, upper), budget)
+
+    def save(self, path):
+        _write_atomic(path, lambda f: pickle.dump(self, f), mode='wb')
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
+def recalibrate(filename, state=None, material=defaultMaterial, M1s=None, workers=1,
+                budget=12, record=None):
+    """
+    Calibrate M1 to a record, resuming from state if the record extends it.
+
+    Parameters
+    ----------
+    filename : str
+        The experimental record, read with datasets.load_xy.
+    state : CalibrationState, optional
+        The state of an earlier calibration. It is updated in place if the
+        record is its record with rows appended, otherwise the calibration
+        starts over.
+    material : str, optional
+        A key of OpenSeesMaterialDefaultValues.
+    M1s : array, optional
+        The grid of a calibration from scratch. The default is 100 values
+        from 1 to 5000.
+    workers : int, optional
+        Worker processes for the grid, see grid_runner.run_grid.
+    budget : int, optional
+        The simulations of the refinement around the best M1.
+    record : dict, optional
+        The columns and scales of a file missing from datasets.RECORDS.
+
+    Returns
+    -------
+    state : CalibrationState
+    """
+    xy = np.asarray(load_xy(filename, record=record))
+    if state is None or not state.extends(filename, xy, material):
+        state = CalibrationState(filename, material)
+    elif len(xy) == state.nRows:
+        print("No rows appended, the calibration is up to date")
+        return state
+
+    changed = state.append_rows(xy)
+    resumed = len(state.M1s) > 0
+    if not resumed:
+        state.add_candidates(np.linspace(1, 5000, num=100) if M1s is None else M1s, workers)
+    print("Backbone points: ", len(state.backbone), " changed: ", changed,
+          " LPsteps: ", state.LPsteps)
+
+    # With no backbone point changed, the MAE and its best are those the
+    # last refinement ended on
+    if not resumed or changed:
+        state.refine(budget)
+    return state
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Calibrate M1 to a record, resuming the last calibration if it grew")
+    parser.add_argument("record", help="the experimental csv")
+    parser.add_argument("--state", default=None,
+                        help="file the calibration state is kept in, by default the record "
+                             "name with .calibration")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes, 0 uses every core")
+    parser.add_argument("--budget", type=int, default=12,
+                        help="simulations of the refinement around the best M1")
+    args = parser.parse_args()
+
+    statePath = args.state or os.path.splitext(args.record)[0] + '.calibration'
+    state = CalibrationState.load(statePath) if os.path.exists(statePath) else None
+    state = recalibrate(args.record, state, workers=args.workers, budget=args.budget)
+    state.save(statePath)
+
+    mae, M1 = state.best()
+    print("Error: ", mae, " M1: ", M1, " after ", len(state.M1s), " simulations")
@@ -0,0 +1,69 @@
+"""
+Figures for the backbone comparison, rendered after the search has finished.
+
+The search itself only handles arrays. Each figure is described by a job, a
+module level function and its arguments, and the jobs are drawn in a pool of
+worker processes using the Agg backend. No figure state is kept in the
+process that ran the search.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+
+def _init_worker():
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def hysteresis_figure(xy, filename):
+    """
+    Plot a hysteresis with its reversal points, as Hysteresis.plot(True).
+    """
+    import matplotlib.pyplot as plt
+    import hysteresis as hys
+
+    fig, ax = plt.subplots()
+    hys.Hysteresis(xy).plot(True)
+    plt.savefig(filename)
+    plt.close(fig)
+    return filename
+
+
+def comparison_figure(curves, filename):
+    """
+    Plot a list of (x, y) curves on one set of axes.
+    """
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots()
+    for x_values, y_values in curves:
+        ax.plot(x_values, y_values)
+    plt.savefig(filename)
+    plt.close(fig)
+    return filename
+
+
+def render_figures(jobs, workers=0):
+    """
+    Draw every figure and return the file names written.
+
+    Parameters
+    ----------
+    jobs : list of tuple
+        (function, args) pairs, e.g. (comparison_figure, (curves, filename)).
+    workers : int, optional
+        The number of processes to draw with, 0 uses every available core.
+    """
+    if not jobs:
+        return []
+    if workers == 0:
+        workers = os.cpu_count()
+    for _, args in jobs:
+        directory = os.path.dirname(args[-1])
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs)),
+                             initializer=_init_worker) as executor:
+        futures = [executor.submit(function, *args) for function, args in jobs]
+        return [future.result() for future in futures]
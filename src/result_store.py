@@ -0,0 +1,183 @@
+"""
+Compact columnar storage of the results of many candidates.
+
+A grid search over several parameters keeps a result per candidate, and a
+result as a tuple of float64 arrays (or a hys.Hysteresis) per candidate soon
+takes more memory than the search itself. Every candidate is simulated on the
+same strain history, so its backbone, or its hysteresis, shares one x with all
+the others. Here x is kept once and the y of every candidate is a row of one
+2-D array, in float32 by default, next to columns of the candidates and their
+errors. Once the rows outgrow maxBytes they are moved to a memory-mapped file,
+so only the pages in use are held in memory.
+
+    store = ResultStore()
+    grid_search(backbone_x, backbone_y, store=store)
+    M1, error, x, y = store[store.best()]
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+class ResultStore:
+    """
+    The candidates, errors and y of many results that share an x.
+
+    Parameters
+    ----------
+    x : array, optional
+        The shared x, e.g. the strain history or the x of the simulated
+        backbones. The default takes it from the first result appended.
+    dtype : dtype, optional
+        The type the y are stored in. The default float32 halves the memory
+        of float64, x, the candidates and the errors stay float64.
+    maxBytes : int, optional
+        The size of the y rows kept in memory, beyond which they are spilled
+        to a memory-mapped file.
+    directory : str, optional
+        Where the memory-mapped file is created. The default is a new
+        temporary directory, removed by close.
+    """
+
+    def __init__(self, x=None, dtype=np.float32, maxBytes=256*2**20, directory=None):
+        self.x = None if x is None else np.asarray(x, dtype=float)
+        self.dtype = np.dtype(dtype)
+        self.maxBytes = maxBytes
+        self.directory = directory
+        self.size = 0
+        self.candidates = np.empty(0)
+        self.errors = np.empty(0)
+        self.y = None
+        self._path = None
+        self._temporary = None
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        """
+        The candidate, error, x and y (as float64) of result i.
+        """
+        if not -self.size <= i < self.size:
+            raise IndexError('result {} out of {}'.format(i, self.size))
+        i %= self.size
+        return self.candidates[i], self.errors[i], self.x, self.y[i].astype(float)
+
+    @property
+    def spilled(self):
+        return self._path is not None
+
+    @property
+    def nbytes(self):
+        # The memory of the y rows in use, wherever they are kept
+        return 0 if self.y is None else self.size*self.y.shape[1]*self.dtype.itemsize
+
+    def append(self, candidate, error, x, y):
+        """
+        Add a result. An x of None, e.g. an abandoned candidate, stores a row
+        of nan. x must otherwise be the x of the store.
+        """
+        if x is not None:
+            if self.x is None:
+                self.x = np.asarray(x, dtype=float)
+            elif x is not self.x and not np.array_equal(x, self.x):
+                raise ValueError('The results of a ResultStore must share x')
+        if self.x is None:
+            raise ValueError('The x of the store is unknown until a result has one')
+
+        if self.y is None or self.size == len(self.y):
+            self._grow(max(16, 2*self.size))
+        self.candidates[self.size] = candidate
+        self.errors[self.size] = error
+        self.y[self.size] = np.nan if y is None else y
+        self.size += 1
+
+    def extend(self, candidates, results):
+        """
+        Add the (error, x, y) results of candidates, as returned by run_grid.
+        """
+        for candidate, (error, x, y) in zip(candidates, results):
+            self.append(candidate, error, x, y)
+
+    def best(self):
+        """
+        The index of the lowest error, the first among equal ones.
+        """
+        return int(np.argmin(self.errors[:self.size]))
+
+    def _grow(self, capacity):
+        rowBytes = len(self.x)*self.dtype.itemsize
+        candidates = np.empty(capacity)
+        errors = np.empty(capacity)
+        candidates[:self.size] = self.candidates[:self.size]
+        errors[:self.size] = self.errors[:self.size]
+
+        if capacity*rowBytes <= self.maxBytes:
+            y = np.empty((capacity, len(self.x)), dtype=self.dtype)
+            path = None
+        else:
+            # Each spill gets a new file, the rows are copied over and the
+            # old file removed, as a memmap cannot be resized in place
+            if self._temporary is None and self.directory is None:
+                self._temporary = tempfile.mkdtemp(prefix='results')
+            path = os.path.join(self.directory or self._temporary,
+                                'results.{}.{}.y'.format(os.getpid(), capacity))
+            y = np.memmap(path, dtype=self.dtype, mode='w+', shape=(capacity, len(self.x)))
+        if self.y is not None:
+            y[:self.size] = self.y[:self.size]
+
+        self._release()
+        self.candidates = candidates
+        self.errors = errors
+        self.y = y
+        self._path = path
+
+    def _release(self):
+        # Drop the spill file of the current rows, if any
+        if self._path is not None:
+            self.y = None
+            os.remove(self._path)
+            self._path = None
+
+    def save(self, path):
+        """
+        Write the results to a .npz file, with the y in the dtype of the store.
+        """
+        y = np.empty((0, 0), dtype=self.dtype) if self.y is None else self.y[:self.size]
+        np.savez(path, x=np.empty(0) if self.x is None else self.x,
+                 candidates=self.candidates[:self.size], errors=self.errors[:self.size], y=y)
+
+    @classmethod
+    def load(cls, path, maxBytes=256*2**20, directory=None):
+        """
+        Read a store written by save.
+        """
+        with np.load(path) as data:
+            store = cls(data['x'] if len(data['x']) else None, data['y'].dtype, maxBytes,
+                        directory)
+            if len(data['y']):
+                store._grow(len(data['y']))
+                store.candidates[:] = data['candidates']
+                store.errors[:] = data['errors']
+                store.y[:] = data['y']
+                store.size = len(data['y'])
+        return store
+
+    def close(self):
+        """
+        Remove the memory-mapped file, the results can no longer be read.
+        """
+        self._release()
+        self.y = None
+        self.size = 0
+        if self._temporary is not None:
+            shutil.rmtree(self._temporary, ignore_errors=True)
+            self._temporary = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,275 @@
+"""
+Backbone extraction for records too long to hold in memory.
+
+StreamingBackbone takes a hysteresis in chunks of xy points. It finds the
+reversal points as the data arrives, hands back every completed cycle and
+keeps the backbone up to date. Only the samples since the last reversal are
+held, so memory is bounded by the length of a cycle rather than the record.
+
+Reversals are the local extrema of x found by scipy's find_peaks, with the
+first and last samples added at each end, less those within the noise
+tolerance of backbone.get_reversals, which is applied as they arrive. With
+the tolerance of the whole record, noise times its range, the reversals,
+cycles and backbone are the same as those of backbone.get_backbone_curve;
+without it the tolerance follows the range of x read so far. With a
+tolerance of 0 they are those of hys.Hysteresis and hys.getBackboneCurve.
+"""
+import numpy as np
+from scipy.signal import find_peaks
+from hysteresis.data import getCycleIndexes
+
+from backbone import NOISE
+from datasets import iter_xy
+
+
+def _LPindexes(LPsteps):
+    # The positive reversals on the backbone, as in hysteresis' _LPparser
+    return np.concatenate([[0, 1], np.cumsum(LPsteps[:-1], dtype=int) + 1])
+
+
+def _cycle_peak(cycle):
+    # The highest peak of y in a cycle, as getBackboneCurve(returnPeaks=True)
+    y = cycle[:, 1]
+    peakIndexes = getCycleIndexes(y)
+    if y[peakIndexes[0]] < y[peakIndexes[1]]:
+        maxIndexes = peakIndexes[1::2]
+    else:
+        maxIndexes = peakIndexes[0::2]
+    return cycle[maxIndexes[np.argmax(y[maxIndexes])]]
+
+
+class StreamingBackbone:
+    """
+    Incremental equivalent of hys.getBackboneCurve(hys.Hysteresis(xy), ...).
+
+    Parameters
+    ----------
+    LPsteps : list of int, optional
+        The number of cycles at each load protocol step. None puts every
+        positive reversal on the backbone.
+    returnPeaks : bool, optional
+        Add the peak of each backbone cycle, as getBackboneCurve.
+    tolerance : float, optional
+        The excursion of x below which it is noise rather than a reversal,
+        e.g. noise times the range of the record. The default is noise times
+        the range of x read so far.
+    noise : float, optional
+        The fraction of the range used without a tolerance.
+    """
+
+    def __init__(self, LPsteps=None, returnPeaks=False, tolerance=None, noise=NOISE):
+        self.returnPeaks = returnPeaks
+        self.selected = None if LPsteps is None else set(_LPindexes(LPsteps).tolist())
+        self.nSelected = None if LPsteps is None else len(self.selected)
+        self.tolerance = tolerance
+        self.noise = noise
+
+        # Samples from the last reversal onwards, and the index of the first
+        self.buffer = np.empty((0, 2))
+        self.offset = 0
+        self.reversals = []
+        self.nPositive = 0
+
+        # The filter of backbone.get_reversals, fed with the local extrema
+        # up to sample scanned: step is the direction x moves in, 0 until it
+        # first leaves its first sample by more than the tolerance, extreme
+        # the (index, x) that becomes a reversal once x leaves it by more
+        # than the tolerance, and low and high the lowest and highest extrema
+        # before the direction is known
+        self.scanned = 0
+        self.step = 0
+        self.extreme = None
+        self.low = self.high = None
+        # The range of x up to sample rangeEnd, without a tolerance
+        self.xMin, self.xMax = np.inf, -np.inf
+        self.rangeEnd = 0
+
+        self.ends = []
+        self.peaks = []
+        self.finished = False
+
+    def update(self, xy):
+        """
+        Add a chunk of (n, 2) xy points and return the cycles it completed.
+        """
+        if self.finished:
+            raise ValueError('The stream has already been finished')
+        xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+        if len(xy) == 0:
+            return []
+
+        if not self.reversals:
+            self._add_reversal(0, xy[0])
+            self.low = self.high = (0, xy[0, 0])
+        self.buffer = np.concatenate([self.buffer, xy])
+
+        # A peak is only found once a lower sample follows it. The buffer
+        # starts at the last reversal, which find_peaks never reports as it
+        # has no sample before it, and the extrema after it up to scanned
+        # were already fed to the filter.
+        x = self.buffer[:, 0]
+        maxIndexes, _ = find_peaks(x, height=(None, None), distance=2)
+        minIndexes, _ = find_peaks(-x, height=(None, None), distance=2)
+        extrema = np.sort(np.concatenate([maxIndexes, minIndexes])) + self.offset
+
+        cycles = []
+        for index in extrema[extrema > self.scanned]:
+            cycles.extend(self._filter(int(index)))
+            self.scanned = int(index)
+        return cycles
+
+    def finish(self):
+        """
+        Close the last cycle at the final sample and return the backbone.
+        """
+        if not self.finished:
+            last = self.offset + len(self.buffer) - 1
+            if last > self.offset:
+                tolerance = self._tolerance(last)
+                if (self.extreme is not None
+                        and (self.extreme[1] - self.buffer[-1, 0])*self.step > tolerance):
+                    self._close_cycle(self.extreme[0])
+                self._close_cycle(last)
+            if self.nSelected is not None and len(self.ends) < self.nSelected:
+                raise ValueError('The record has {} backbone cycles but LPsteps needs {}'.format(
+                    len(self.ends), self.nSelected))
+            self.finished = True
+        return self.backbone
+
+    def step_peaks(self):
+        """
+        The x of the positive reversals so far, as protocol.get_step_peaks of
+        the data so far with the same tolerance. After finish() the final
+        sample is left out, as get_step_peaks does.
+        """
+        reversalX = np.array([x for _, x in self.reversals])
+        if self.finished:
+            reversalX = reversalX[:-1]
+        return reversalX[1:][np.diff(reversalX) >= 0]
+
+    def select(self, LPsteps):
+        """
+        The backbone for LPsteps of a finished stream started without
+        LPsteps, which keeps every positive reversal. The same record can be
+        reduced for a protocol that is only known once it has been read.
+        """
+        if self.selected is not None:
+            raise ValueError('The stream already selects its LPsteps')
+        indexes = _LPindexes(LPsteps)
+        if indexes[-1] >= len(self.ends):
+            raise ValueError('The record has {} backbone cycles but LPsteps needs {}'.format(
+                len(self.ends), indexes[-1] + 1))
+        # peaks[i] is the peak of the cycle ending at the positive reversal i + 1
+        return self._points([self.ends[i] for i in indexes],
+                            [self.peaks[i - 1] for i in indexes[1:]])
+
+    def _add_reversal(self, index, point):
+        # Record a reversal, and if it is a positive one on the backbone, its
+        # end point. Returns True if it is on the backbone.
+        positive = not self.reversals or point[0] >= self.reversals[-1][1]
+        self.reversals.append((index, point[0]))
+        if not positive:
+            return False
+
+        ordinal = self.nPositive
+        self.nPositive += 1
+        if self.selected is not None and ordinal not in self.selected:
+            return False
+        self.ends.append(point.copy())
+        return ordinal > 0
+
+    def _tolerance(self, index):
+        if self.tolerance is not None:
+            return self.tolerance
+        x = self.buffer[self.rangeEnd - self.offset:index - self.offset + 1, 0]
+        if len(x):
+            self.xMin = min(self.xMin, x.min())
+            self.xMax = max(self.xMax, x.max())
+            self.rangeEnd = index + 1
+        return self.noise*(self.xMax - self.xMin)
+
+    def _filter(self, index):
+        # One extremum through the loop of backbone._filter_reversals,
+        # returning the cycles it closes
+        value = self.buffer[index - self.offset, 0]
+        tolerance = self._tolerance(index)
+        cycles = []
+        if self.step == 0:
+            first = self.reversals[0][1]
+            if value < self.low[1]:
+                self.low = (index, value)
+            if value > self.high[1]:
+                self.high = (index, value)
+            if value - self.low[1] > tolerance:
+                if first - self.low[1] > tolerance:
+                    cycles.append(self._close_cycle(self.low[0]))
+                self.step, self.extreme = 1, (index, value)
+            elif self.high[1] - value > tolerance:
+                if self.high[1] - first > tolerance:
+                    cycles.append(self._close_cycle(self.high[0]))
+                self.step, self.extreme = -1, (index, value)
+        elif (value - self.extreme[1])*self.step > 0:
+            self.extreme = (index, value)
+        elif (self.extreme[1] - value)*self.step > tolerance:
+            cycles.append(self._close_cycle(self.extreme[0]))
+            self.step, self.extreme = -self.step, (index, value)
+        return cycles
+
+    def _close_cycle(self, index):
+        # Close the cycle from the last reversal to sample index
+        cycle = self.buffer[:index - self.offset + 1]
+        self.buffer = self.buffer[index - self.offset:]
+        self.offset = index
+        if self._add_reversal(index, cycle[-1]) and self.returnPeaks:
+            self.peaks.append(_cycle_peak(cycle))
+        return cycle
+
+    @property
+    def backbone(self):
+        """
+        The backbone of the data so far, as getBackboneCurve(...).xy.
+        """
+        return self._points(self.ends, self.peaks[:len(self.ends) - 1])
+
+    def _points(self, ends, peaks):
+        points = list(ends)
+        if self.returnPeaks and ends:
+            # getBackboneCurve leaves the peak of its last cycle as the origin
+            points += list(peaks) + [np.zeros(2)]
+        if not points:
+            return np.empty((0, 2))
+        points = np.array(points)
+        _, indexes = np.unique(points[:, 0], return_index=True)
+        return points[indexes]
+
+
+def stream_backbone(chunks, LPsteps=None, returnPeaks=False, onCycle=None, tolerance=None):
+    """
+    Build the backbone of a hysteresis given as an iterable of xy chunks.
+
+    onCycle, if given, is called with every completed cycle.
+    """
+    streaming = StreamingBackbone(LPsteps, returnPeaks, tolerance)
+    for chunk in chunks:
+        for cycle in streaming.update(chunk):
+            if onCycle is not None:
+                onCycle(cycle)
+    return streaming.finish()
+
+
+def stream_backbone_file(filename, LPsteps=None, returnPeaks=False, chunksize=2**16,
+                         xScale=None, yScale=None):
+    """
+    The backbone of a record in datasets.RECORDS, read chunksize rows at a time.
+
+    The record is read twice, first for the range of x, so that its noise
+    tolerance, and with it the backbone, is that of get_backbone_curve.
+    """
+    xMin, xMax = np.inf, -np.inf
+    for chunk in iter_xy(filename, chunksize, xScale, yScale):
+        if len(chunk):
+            xMin = min(xMin, chunk[:, 0].min())
+            xMax = max(xMax, chunk[:, 0].max())
+    tolerance = NOISE*(xMax - xMin) if xMax >= xMin else 0.
+    return stream_backbone(iter_xy(filename, chunksize, xScale, yScale), LPsteps, returnPeaks,
+                           tolerance=tolerance)